@@ -0,0 +1,288 @@
+"""
+Rough benchmarks for the math module.
+
+Build the extension first (``python setup.py build_ext --inplace``), then
+run with ``python benchmarks/bench_math.py [name ...]`` from the project
+root. With no arguments every benchmark is run.
+"""
+
+import bisect
+import os
+import random
+import sys
+import time
+import tracemalloc
+from array import array
+
+from utils import math
+
+
+MB = 1024 * 1024
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def traced(func, *args):
+    """
+    Time a function call, then call it again under tracemalloc to find the
+    peak memory it allocates (tracing slows allocation-heavy code down too
+    much to time the same run).
+    """
+    duration, result = timed(func, *args)
+    del result
+
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return duration, peak, result
+
+
+def count(primes):
+    return sum(1 for _ in primes)
+
+
+def bench_segmented():
+    n = 10**7
+    for name, func in [('sieve_of_erosthenes', math.sieve_of_erosthenes),
+                       ('segmented_sieve', math.segmented_sieve)]:
+        duration, peak, primes = traced(lambda n: count(func(n)), n)
+        print('segmented: {:<20}  n=1e7  {} primes  {:6.2f}s  '
+              'peak {:7.1f} MB'.format(name, primes, duration, peak / MB))
+
+    for lo in (10**9, 10**12):
+        hi = lo + 10**8
+        duration, peak, primes = traced(
+            lambda lo, hi: count(math.primes_between(lo, hi)), lo, hi)
+        print('segmented: primes_between  [{:.0e}, +1e8)  {} primes  '
+              '{:6.2f}s  peak {:7.1f} MB'.format(lo, primes, duration,
+                                                 peak / MB))
+
+
+def bench_packed():
+    n = 10**8
+    for name, func in [('sieve_of_erosthenes', math.sieve_of_erosthenes),
+                       ('packed_sieve', math.packed_sieve)]:
+        duration, peak, primes = traced(func, n)
+        print('packed: {:<20}  n=1e8  {} primes  {:6.2f}s  '
+              'peak {:7.1f} MB'.format(name, len(primes), duration,
+                                       peak / MB))
+        del primes
+
+
+def bench_parallel():
+    n = 10**8
+    cores = os.cpu_count() or 1
+    workers = sorted({1, 2, 4, 8, 16, 32, cores})
+    baseline = None
+    for count in workers:
+        duration, primes = timed(math.parallel_sieve, n, count)
+        baseline = baseline or duration
+        print('parallel: {:>2} workers ({} cores)  n=1e8  {} primes  {:6.2f}s  '
+              '{:4.1f}x'.format(count, cores, len(primes), duration,
+                                baseline / duration))
+        del primes
+
+
+def grow_with_sieve(limits):
+    for n in limits:
+        primes = math.packed_sieve(n)
+    return len(primes)
+
+
+def grow_with_table(limits):
+    table = math.PrimeTable()
+    for n in limits:
+        primes = table.primes_upto(n)
+    return len(primes)
+
+
+def bench_table():
+    # A service asking for slowly growing limits
+    limits = range(10**6, 2 * 10**7 + 1, 10**6)
+    for func in (grow_with_sieve, grow_with_table):
+        duration, primes = timed(func, limits)
+        print('table: {:<16}  {} limits up to 2e7  {:6.2f}s'.format(
+              func.__name__, len(limits), duration))
+
+    table = math.PrimeTable()
+    table.extend(10**7)
+    numbers = range(1, 10**7, 3)
+    duration, found = timed(lambda: sum(map(table.is_prime, numbers)))
+    print('table: is_prime  {} lookups  {:6.2f}s  {:5.0f} ns/lookup'.format(
+          len(numbers), duration, duration / len(numbers) * 1e9))
+
+
+def bench_many():
+    random.seed(1)
+    values = array('Q', [random.getrandbits(64) | 1 for _ in range(10**6)])
+    sample = values[:10**4]
+
+    duration, found = timed(lambda: sum(math.is_prime_many(values)))
+    print('many: is_prime_many  {} odd 64-bit values  {} primes  {:6.2f}s  '
+          '{:5.0f} ns/value'.format(len(values), found, duration,
+                                    duration / len(values) * 1e9))
+
+    # The usual alternative: a Miller-Rabin test written in Python
+    duration, found = timed(lambda: sum(map(miller_rabin, sample)))
+    print('many: python loop    {} odd 64-bit values  {} primes  {:6.2f}s  '
+          '{:5.0f} ns/value'.format(len(sample), found, duration,
+                                    duration / len(sample) * 1e9))
+
+
+def miller_rabin(n):
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d, s = d // 2, s + 1
+    for a in (2, 325, 9375, 28178, 450775, 9780504, 1795265022):
+        x = pow(a % n, d, n)
+        if x in (0, 1, n - 1):
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def bench_average():
+    n = 10**8
+    data = array('d', [0.1]) * n
+
+    # The old average() only took lists, so callers had to convert first
+    small = data[:10**7]
+    duration, result = timed(lambda: math.average(small.tolist()))
+    print('average: tolist() + naive  n=1e7  {:6.3f}s'.format(duration))
+
+    for method in ('naive', 'pairwise', 'kahan'):
+        duration, result = timed(math.average, data, method)
+        print('average: {:<8}  n=1e8  {:6.3f}s  relative error {:.1e}'.format(
+              method, duration, abs(result - 0.1) / 0.1))
+
+
+def bench_stats():
+    batch = array('d', range(10**6))
+    batches = 100
+
+    def stream():
+        stats = math.RunningStats()
+        for _ in range(batches):
+            stats.update(batch)
+        return stats
+
+    duration, stats = timed(stream)
+    print('stats: update()  {} x 1e6 doubles  {:6.2f}s  {:6.1f} M values/s'
+          .format(batches, duration, batches / duration))
+
+    values = batch.tolist()
+
+    def one_at_a_time():
+        stats = math.RunningStats()
+        add = stats.add
+        for value in values:
+            add(value)
+        return stats
+
+    duration, stats = timed(one_at_a_time)
+    print('stats: add()     1e6 floats          {:6.2f}s  {:6.1f} M values/s'
+          .format(duration, len(values) / duration / 1e6))
+
+
+def sliced_means(data, window):
+    return array('d', (math.average(data[i - window:i])
+                       for i in range(window, len(data) + 1)))
+
+
+def bench_rolling():
+    random.seed(1)
+    data = array('d', [random.random() for _ in range(10**6)])
+
+    # Slicing is O(n * window), so only time it on a tenth of the data
+    for window in (10, 100, 1000):
+        duration, slow = timed(sliced_means, data[:10**5], window)
+        print('rolling: average(slice)  window={:<5} {:7.1f} ns/value'.format(
+              window, duration / len(slow) * 1e9))
+
+        duration, fast = timed(math.rolling, data, window)
+        print('rolling: rolling()       window={:<5} {:7.1f} ns/value'.format(
+              window, duration / len(fast) * 1e9))
+
+    for statistic in ('sum', 'min', 'max', 'ewma'):
+        duration, fast = timed(math.rolling, data, 1000, statistic)
+        print('rolling: rolling({!r:<6})  window=1000  {:7.1f} ns/value'
+              .format(statistic, duration / len(fast) * 1e9))
+
+
+def exact_quantiles(data, qs):
+    ordered = sorted(data)
+    return [ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+            for q in qs]
+
+
+def sketched_quantiles(data, qs, compression):
+    digest = math.TDigest(compression)
+    digest.update(data)
+    return digest.quantiles(qs)
+
+
+def bench_digest():
+    random.seed(1)
+    data = array('d', [random.lognormvariate(0, 1) for _ in range(10**7)])
+    qs = [0.5, 0.99, 0.999]
+
+    duration, peak, exact = traced(exact_quantiles, data, qs)
+    print('digest: sorted()      n=1e7  {:6.2f}s  peak {:7.1f} MB'.format(
+          duration, peak / MB))
+    ordered = sorted(data)
+
+    for compression in (100, 500):
+        duration, peak, sketched = traced(sketched_quantiles, data, qs,
+                                          compression)
+        print('digest: TDigest({})  n=1e7  {:6.2f}s  peak {:7.1f} MB'.format(
+              compression, duration, peak / MB))
+
+        for q, expected, estimate in zip(qs, exact, sketched):
+            rank = bisect.bisect_left(ordered, estimate) / len(ordered)
+            print('digest:   p{:<5g} exact {:8.4f}  estimate {:8.4f}  '
+                  'rank error {:.1e}'.format(q * 100, expected, estimate,
+                                             abs(rank - q)))
+
+
+def bench_count():
+    n = 10**8
+    duration, peak, primes = traced(lambda n: len(math.packed_sieve(n)), n)
+    print('count: len(packed_sieve())  n=1e8   {:6.3f}s  peak {:7.1f} MB'
+          .format(duration, peak / MB))
+
+    for exponent in (8, 10, 12, 13):
+        duration, peak, primes = traced(math.prime_count, 10**exponent)
+        print('count: prime_count()        n=1e{:<3} {:6.3f}s  peak {:7.1f} MB'
+              '  {} primes'.format(exponent, duration, peak / MB, primes))
+
+
+BENCHMARKS = {
+    'count': bench_count,
+    'digest': bench_digest,
+    'rolling': bench_rolling,
+    'stats': bench_stats,
+    'average': bench_average,
+    'many': bench_many,
+    'table': bench_table,
+    'parallel': bench_parallel,
+    'packed': bench_packed,
+    'segmented': bench_segmented,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
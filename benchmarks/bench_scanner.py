@@ -0,0 +1,352 @@
+"""
+Rough throughput benchmarks for the scanner module.
+
+Run with ``python benchmarks/bench_scanner.py [name ...]`` from the project
+root. With no arguments every benchmark is run.
+"""
+
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from utils.scanner import (StringScanner, StreamScanner, Lexer, Parser, rule,
+                           LRUMemoTable)
+
+
+MB = 1024 * 1024
+
+LOG_LINE = ('2016-03-14 12:34:56 INFO worker-7 handled request id=4242 '
+            'path=/api/v1/things status=200 took=0.0123\n')
+
+
+def make_log(size):
+    """
+    Build roughly `size` characters of log-like text.
+    """
+    return LOG_LINE * (size // len(LOG_LINE) + 1)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def lex_words(text):
+    """
+    The typical hand-written lexing loop: try each rule in turn.
+    """
+    scanner = StringScanner(text)
+    tokens = 0
+    while not scanner.end_of_string:
+        if scanner.skip(r'[ \t\n]+'):
+            continue
+        if scanner.skip(r'[\w.:/=-]+'):
+            tokens += 1
+            continue
+        scanner.getch()
+    return tokens
+
+
+LOG_RULES = [
+    ('DATE', r'\d{4}-\d\d-\d\d'),
+    ('TIME', r'\d\d:\d\d:\d\d'),
+    ('LEVEL', r'DEBUG|INFO|WARNING|ERROR'),
+    ('FIELD', r'\w+=[^\s]+'),
+    ('NAME', r'[\w.-]+'),
+    ('SPACE', r'[ \t\n]+', Lexer.SKIP),
+]
+
+
+def lex_rule_by_rule(text):
+    """
+    Try each of `LOG_RULES` in turn with `StringScanner.scan()`.
+    """
+    scanner = StringScanner(text)
+    rules = LOG_RULES
+    tokens = 0
+    while not scanner.end_of_string:
+        for rule in rules:
+            if scanner.scan(rule[1]):
+                if len(rule) == 2:
+                    tokens += 1
+                break
+        else:
+            raise ValueError('Stuck at {}'.format(scanner.pos))
+    return tokens
+
+
+def lex_master_regex(text):
+    lexer = Lexer(LOG_RULES)
+    return sum(1 for _ in lexer.tokenize(text))
+
+
+def bench_search():
+    for size in (1 * MB, 10 * MB, 100 * MB):
+        text = make_log(size)
+        duration, tokens = timed(lex_words, text)
+        print('search: {:>4} MB  {:>9} tokens  {:6.2f}s  {:6.1f} MB/s'.format(
+              size // MB, tokens, duration, len(text) / MB / duration))
+
+
+def bench_lexer():
+    text = make_log(10 * MB)
+    for name, func in [('rule-by-rule', lex_rule_by_rule),
+                       ('Lexer', lex_master_regex)]:
+        duration, tokens = timed(func, text)
+        print('lexer: {:<12}  {:>9} tokens  {:6.2f}s  {:6.1f} MB/s'.format(
+              name, tokens, duration, len(text) / MB / duration))
+
+
+def bench_stream():
+    """
+    Lex a file through a StreamScanner, keeping an eye on peak memory.
+    """
+    size = 200 * MB
+    with tempfile.NamedTemporaryFile('w', suffix='.log', delete=False) as f:
+        for _ in range(size // MB):
+            f.write(make_log(MB))
+    try:
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        with open(f.name) as stream:
+            duration, tokens = timed(lex_master_regex, StreamScanner(stream))
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        os.unlink(f.name)
+
+    print('stream: {} MB file  {} tokens  {:.2f}s  {:.1f} MB/s  '
+          'peak RSS grew by {:.1f} MB'.format(
+              size // MB, tokens, duration, size / MB / duration,
+              (rss_after - rss_before) / 1024))
+
+
+class ConcatScanner(StringScanner):
+    """
+    A scanner using the old `self.text += value` append, for comparison.
+    """
+    def append(self, value):
+        self.text += value
+
+
+def feed(scanner, chunks):
+    """
+    Feed a scanner lots of small chunks, consuming whatever complete words
+    are available after each one (like a protocol parser reading a socket).
+    """
+    words = 0
+    for chunk in chunks:
+        scanner.append(chunk)
+        while scanner.scan(r'\w+ '):
+            words += 1
+    return words
+
+
+def feed_then_scan(scanner, chunks):
+    for chunk in chunks:
+        scanner.append(chunk)
+    return lex_words(scanner.text)
+
+
+def bench_append():
+    small = ['word{} '.format(i % 1000) for i in range(10 ** 5)]
+    large = ['word{} '.format(i % 1000) for i in range(10 ** 6)]
+
+    # Anything which re-copies the whole text on every append is quadratic,
+    # so those only get the smaller input
+    runs = [
+        ('interleaved', 'text += value', feed, ConcatScanner, small),
+        ('interleaved', 'chunk list', feed, StringScanner, small),
+        ('interleaved', 'compact=True', feed, StringScanner, small),
+        ('interleaved', 'compact=True', feed, StringScanner, large),
+        ('append all', 'text += value', feed_then_scan, ConcatScanner, small),
+        ('append all', 'chunk list', feed_then_scan, StringScanner, small),
+        ('append all', 'chunk list', feed_then_scan, StringScanner, large),
+    ]
+
+    for scenario, name, func, cls, chunks in runs:
+        scanner = cls('', compact=name == 'compact=True')
+        duration, _ = timed(func, scanner, chunks)
+        print('append: {:<12} {:<14} {:>8} chunks  {:7.2f}s'.format(
+              scenario, name, len(chunks), duration))
+
+
+def bench_parallel():
+    text = make_log(50 * MB)
+    lexer = Lexer(LOG_RULES)
+
+    duration, tokens = timed(lambda: sum(1 for _ in lexer.tokenize(text)))
+    print('parallel: serial      {} tokens  {:6.2f}s'.format(tokens, duration))
+
+    for workers in sorted({1, 2, os.cpu_count() or 1}):
+        duration, tokens = timed(lambda: sum(
+            1 for _ in lexer.tokenize_parallel(text, workers=workers)))
+        print('parallel: {:>2} workers  {} tokens  {:6.2f}s'.format(
+              workers, tokens, duration))
+
+
+class Calculator(Parser):
+    """
+    A naive grammar which re-parses `term` for each alternative of `expr`,
+    which is exponential in the nesting depth without memoization.
+    """
+    @rule
+    def expr(self):
+        return self.choice(self.sum, self.difference, self.term)
+
+    @rule
+    def sum(self):
+        left = self.term()
+        self.expect(r'\+')
+        return left + self.expr()
+
+    @rule
+    def difference(self):
+        left = self.term()
+        self.expect(r'-')
+        return left - self.expr()
+
+    @rule
+    def term(self):
+        return self.choice(self.number, self.parens)
+
+    @rule
+    def number(self):
+        return int(self.expect(r'\d+'))
+
+    @rule
+    def parens(self):
+        self.expect(r'\(')
+        value = self.expr()
+        self.expect(r'\)')
+        return value
+
+
+def bench_packrat():
+    for depth in (4, 6, 8, 10, 40, 80):
+        text = '(' * depth + '1' + ')' * depth
+
+        # An LRU table of size 0 remembers nothing, like a plain
+        # recursive-descent parser. It's hopeless past a depth of 10.
+        naive = '-'
+        if depth <= 10:
+            memo = LRUMemoTable(maxsize=0)
+            naive = '{:.4f}s'.format(
+                timed(Calculator(text, memo=memo).parse, 'expr')[0])
+        packrat, _ = timed(Calculator(text).parse, 'expr')
+
+        print('packrat: depth {:>2}  no memo {:>9}  packrat {:.4f}s'.format(
+              depth, naive, packrat))
+
+
+def bench_compact():
+    text = make_log(10 * MB)
+    lexer = Lexer(LOG_RULES)
+
+    for name, func in [('list(tokenize())', lambda: list(lexer.tokenize(text))),
+                       ('tokenize_compact()', lambda: lexer.tokenize_compact(text))]:
+        duration, _ = timed(func)
+        tracemalloc.start()
+        tokens = func()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('compact: {:<18}  {} tokens  {:6.2f}s  {:6.1f} MB  '
+              '{:5.1f} bytes/token'.format(
+                  name, len(tokens), duration, size / MB, size / len(tokens)))
+        del tokens
+
+
+def skip_comments(text, method):
+    scanner = StringScanner(text)
+    blocks = 0
+    while getattr(scanner, method)(r'/\*'):
+        getattr(scanner, method)(r'\*/')
+        blocks += 1
+    return blocks
+
+
+def bench_until():
+    block = 'int x = 1;\n/* ' + 'comment ' * (MB // 8) + '*/\n'
+    text = block * 100
+    for method in ('scan_until', 'skip_until'):
+        duration, blocks = timed(skip_comments, text, method)
+        print('until: {:<10}  {} x 1 MB comments  {:6.3f}s'.format(
+              method, blocks, duration))
+
+
+def extract_with_scan_until(text, pattern):
+    scanner = StringScanner(text)
+    found = []
+    while scanner.skip_until(pattern):
+        found.append(scanner.match[len(scanner.pre_match):])
+    return found
+
+
+def extract_with_iter_matches(text, pattern):
+    return list(StringScanner(text).iter_matches(pattern))
+
+
+def bench_extract():
+    text = make_log(10 * MB)
+    pattern = r'\w+=\S+'
+    for func in (extract_with_scan_until, extract_with_iter_matches):
+        duration, found = timed(func, text, pattern)
+        print('extract: {:<26}  {} matches  {:6.2f}s'.format(
+              func.__name__, len(found), duration))
+
+
+def lex_chars(text):
+    """
+    A lexer which walks the text one character at a time, the way you would
+    for a language that doesn't suit regexes.
+    """
+    scanner = StringScanner(text)
+    tokens = 0
+    while not scanner.end_of_string:
+        char = scanner.getch()
+        if char.isspace():
+            continue
+        if char.isalnum():
+            # Words and numbers (including decimals like 0.0123)
+            while True:
+                current = scanner.current_char
+                if current is None:
+                    break
+                if current.isalnum() or (current == '.' and
+                                         scanner.peek().isdigit()):
+                    scanner.getch()
+                else:
+                    break
+        tokens += 1
+    return tokens
+
+
+def bench_chars():
+    # Run with UTILS_PURE_PYTHON=1 to compare against the pure-Python core
+    core = StringScanner.getch.__module__
+    text = make_log(10 * MB)
+    duration, tokens = timed(lex_chars, text)
+    print('chars: {:<14}  {:>9} tokens  {:6.2f}s  {:6.2f} MB/s'.format(
+          core, tokens, duration, len(text) / MB / duration))
+
+
+BENCHMARKS = {
+    'chars': bench_chars,
+    'extract': bench_extract,
+    'until': bench_until,
+    'compact': bench_compact,
+    'packrat': bench_packrat,
+    'parallel': bench_parallel,
+    'append': bench_append,
+    'stream': bench_stream,
+    'lexer': bench_lexer,
+    'search': bench_search,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
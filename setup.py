@@ -23,7 +23,7 @@ def setup_package():
     sphinx = ['sphinx'] if needs_sphinx else []
     setup(
             setup_requires=['six', 'pyscaffold>=2.5a0,<2.6a0'] + sphinx,
-            ext_modules=cythonize('utils/math.pyx'),
+            ext_modules=cythonize(['utils/math.pyx', 'utils/_scanner.pyx']),
             use_pyscaffold=True
     )
 
@@ -5,6 +5,13 @@ The test suite for the math module of my utils package.
 from utils import math
 import pytest
 import random
+import pickle
+import functools
+import statistics
+from array import array
+from math import fsum, isnan
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
 
 
 def test_average_valid_input_random():
@@ -29,6 +36,51 @@ def test_average_invalid_input():
         math.average(numbers)
 
 
+@pytest.mark.parametrize('typecode', ['d', 'f', 'b', 'H', 'i', 'l', 'Q'])
+def test_average_buffers(typecode):
+    numbers = array(typecode, [1, 2, 3, 4, 5, 6, 7])
+    assert math.average(numbers) == 4
+    assert math.average(memoryview(numbers)) == 4
+
+
+def test_average_iterables():
+    assert math.average(range(10)) == 4.5
+    assert math.average(x / 2 for x in range(4)) == 0.75
+
+
+def test_average_multidimensional_buffer():
+    matrix = memoryview(array('d', range(6))).cast('B').cast('d', (2, 3))
+    assert math.average(matrix) == 2.5
+
+
+@pytest.mark.parametrize('method', ['naive', 'pairwise', 'kahan'])
+def test_average_methods_agree(method):
+    random.seed(5)
+    numbers = array('d', [random.random() for i in range(1000)])
+    assert math.average(numbers, method) == pytest.approx(
+        fsum(numbers) / len(numbers))
+
+
+@pytest.mark.parametrize('method', ['pairwise', 'kahan'])
+def test_average_compensated_methods_are_accurate(method):
+    numbers = array('d', [0.1]) * 10**6
+    naive = math.average(numbers)
+    accurate = math.average(numbers, method)
+
+    assert abs(accurate - 0.1) < abs(naive - 0.1)
+    assert abs(accurate - 0.1) < 1e-15
+
+
+def test_average_invalid_method():
+    with pytest.raises(ValueError):
+        math.average([1, 2, 3], 'median')
+
+
+def test_average_empty():
+    with pytest.raises(ZeroDivisionError):
+        math.average(array('d'))
+
+
 def test_sieve_valid_input():
     primes = math.sieve_of_erosthenes(5)
     assert primes == [2, 3, 5]
@@ -48,3 +100,584 @@ def test_sieve_string_input():
     with pytest.raises(TypeError):
         math.sieve_of_erosthenes('hello')
 
+
+def test_sieve_past_int_overflow():
+    # number * number used to overflow a C int above 46340
+    primes = math.sieve_of_erosthenes(50000)
+    assert len(primes) == 5133
+    assert primes[-1] == 49999
+
+
+def test_primes_between():
+    assert list(math.primes_between(10, 30)) == [11, 13, 17, 19, 23, 29]
+
+
+def test_primes_between_is_half_open():
+    assert list(math.primes_between(11, 13)) == [11]
+    assert list(math.primes_between(0, 3)) == [2]
+    assert list(math.primes_between(5, 5)) == []
+
+
+@pytest.mark.parametrize('segment_size', [1, 7, 100, 32768])
+def test_segmented_sieve_matches_sieve(segment_size):
+    expected = math.sieve_of_erosthenes(20000)
+    assert list(math.segmented_sieve(20000, segment_size)) == expected
+
+
+def test_primes_between_random_windows():
+    random.seed(7)
+    primes = math.sieve_of_erosthenes(20000)
+
+    for _ in range(50):
+        lo = random.randrange(20000)
+        hi = random.randrange(lo, 20001)
+        expected = [p for p in primes if lo <= p < hi]
+        assert list(math.primes_between(lo, hi, 64)) == expected
+
+
+def test_primes_between_near_a_trillion():
+    window = math.primes_between(10**12, 10**12 + 100)
+    assert list(window) == [1000000000039, 1000000000061,
+                            1000000000063, 1000000000091]
+
+
+def test_segmented_sieve_is_lazy():
+    primes = math.segmented_sieve(10**13)
+    assert [next(primes) for _ in range(5)] == [2, 3, 5, 7, 11]
+
+
+def test_primes_between_invalid_input():
+    with pytest.raises(TypeError):
+        math.primes_between(1.5, 10)
+    with pytest.raises(ValueError):
+        math.primes_between(-5, 10)
+    with pytest.raises(ValueError):
+        math.primes_between(0, 2**63)
+    with pytest.raises(ValueError):
+        math.segmented_sieve(0)
+
+
+def test_packed_sieve():
+    primes = math.packed_sieve(30)
+    assert primes.typecode == 'l'
+    assert primes.tolist() == [2, 3, 5, 7, 11, 13, 17, 19, 23, 29]
+
+
+@pytest.mark.parametrize('n', [1, 2, 3, 8, 9, 25, 49, 121, 1000])
+def test_packed_sieve_small_limits(n):
+    expected = [p for p in range(2, n + 1)
+                if all(p % d for d in range(2, int(p**0.5) + 1))]
+    assert math.packed_sieve(n).tolist() == expected
+
+
+def test_packed_sieve_matches_segmented_sieve():
+    assert math.packed_sieve(10**6).tolist() == list(
+        math.segmented_sieve(10**6))
+
+
+def test_packed_sieve_invalid_input():
+    with pytest.raises(TypeError):
+        math.packed_sieve(5.5)
+    with pytest.raises(ValueError):
+        math.packed_sieve(0)
+
+
+@pytest.mark.parametrize('workers', [1, 2, 5])
+def test_parallel_sieve_matches_sieve(workers):
+    for n in [1, 2, 3, 10, 97, 100, 65536, 200003]:
+        assert math.parallel_sieve(n, workers) == math.sieve_of_erosthenes(n)
+
+
+def test_parallel_sieve_default_workers():
+    assert math.parallel_sieve(1000) == math.sieve_of_erosthenes(1000)
+
+
+def test_parallel_sieve_invalid_input():
+    with pytest.raises(TypeError):
+        math.parallel_sieve('hello')
+    with pytest.raises(ValueError):
+        math.parallel_sieve(-3)
+    with pytest.raises(ValueError):
+        math.parallel_sieve(100, workers=0)
+
+
+class TestPrimeTable:
+    @pytest.fixture
+    def table(self):
+        return math.PrimeTable()
+
+    @pytest.fixture
+    def primes(self):
+        return math.sieve_of_erosthenes(50000)
+
+    def test_is_prime(self, table, primes):
+        expected = set(primes)
+        for k in range(-3, 50001):
+            assert table.is_prime(k) == (k in expected)
+
+    def test_nth_prime(self, table, primes):
+        for i, prime in enumerate(primes, 1):
+            assert table.nth_prime(i) == prime
+
+    def test_primes_upto(self, table, primes):
+        for n in [0, 1, 2, 3, 100, 5, 50000]:
+            expected = [p for p in primes if p <= n]
+            assert table.primes_upto(n).tolist() == expected
+
+    def test_extends_incrementally(self, table):
+        assert table.limit == 0
+        table.is_prime(101)
+        first = table.limit
+        assert first > 101
+
+        table.is_prime(first + 1)
+        assert table.limit >= 2 * first
+
+    def test_clear(self, table):
+        table.extend(10**5)
+        table.clear()
+        assert table.limit == 0
+        assert table.is_prime(99991)
+
+    def test_memory_cap(self, primes):
+        table = math.PrimeTable(max_bytes=512)
+        expected = set(primes)
+
+        for k in range(0, 50000, 7):
+            assert table.is_prime(k) == (k in expected)
+        assert table.nth_prime(3000) == primes[2999]
+        assert table.primes_upto(40000).tolist() == [
+            p for p in primes if p <= 40000]
+        assert table.limit <= 16 * 512
+
+    def test_past_the_memory_cap(self):
+        table = math.PrimeTable(max_bytes=512)
+        assert table.is_prime(10**12 + 39)
+        assert not table.is_prime(10**12 + 41)
+        assert table.is_prime(2**61 - 1)
+        assert table.limit <= 16 * 512
+
+    def test_invalid_input(self, table):
+        with pytest.raises(TypeError):
+            table.is_prime(2.0)
+        with pytest.raises(ValueError):
+            table.nth_prime(0)
+        with pytest.raises(ValueError):
+            math.PrimeTable(max_bytes=-1)
+        with pytest.raises(TypeError):
+            table.primes_upto('x')
+        with pytest.raises(ValueError):
+            table.primes_upto(2**70)
+        with pytest.raises(ValueError):
+            table.primes_upto(2**62 + 1)
+
+
+def test_module_level_prime_table():
+    assert math.is_prime(1000003)
+    assert not math.is_prime(1000001)
+    assert math.nth_prime(1000) == 7919
+    assert math.primes_upto(20).tolist() == [2, 3, 5, 7, 11, 13, 17, 19]
+    assert math.prime_table.limit > 1000003
+
+
+def test_module_level_prime_table_is_capped():
+    assert math.prime_table.max_bytes is not None
+    assert math.is_prime(10**12 + 39)
+    assert not math.is_prime(10**12 + 41)
+    assert math.prime_table.nbytes < 2 * math.prime_table.max_bytes
+
+
+def test_is_prime_many_small_numbers():
+    values = list(range(-10, 20000))
+    expected = set(math.sieve_of_erosthenes(20000))
+    result = math.is_prime_many(values)
+
+    assert result.typecode == 'B'
+    assert [v for v, flag in zip(values, result) if flag] == sorted(expected)
+
+
+@pytest.mark.parametrize('typecode', ['q', 'Q', 'l', 'L', 'i'])
+def test_is_prime_many_buffers(typecode):
+    values = array(typecode, [0, 1, 2, 3, 4, 97, 561, 7919])
+    assert list(math.is_prime_many(values)) == [0, 0, 1, 1, 0, 1, 0, 1]
+
+
+def test_is_prime_many_large_numbers():
+    values = [
+        2**61 - 1,              # Mersenne prime
+        2**64 - 59,             # largest 64-bit prime
+        2**64 - 1,
+        3825123056546413051,    # strong pseudoprime to bases 2 through 23
+        1000000000039,
+        1000000000039 * 1000003,
+    ]
+    assert list(math.is_prime_many(values)) == [1, 1, 0, 0, 1, 0]
+
+
+def test_is_prime_many_matches_prime_table():
+    random.seed(11)
+    values = [random.randrange(10**7) for _ in range(2000)]
+    expected = [int(math.is_prime(v)) for v in values]
+    assert list(math.is_prime_many(iter(values))) == expected
+
+
+def test_is_prime_many_invalid_input():
+    with pytest.raises(TypeError):
+        math.is_prime_many([1.5])
+    with pytest.raises(ValueError):
+        math.is_prime_many([2**64])
+
+
+def shard_stats(numbers):
+    return math.RunningStats(numbers)
+
+
+class TestRunningStats:
+    @pytest.fixture
+    def numbers(self):
+        random.seed(3)
+        return [random.gauss(1e6, 3) for i in range(5000)]
+
+    def test_add(self, numbers):
+        stats = math.RunningStats()
+        for number in numbers:
+            stats.add(number)
+
+        assert stats.count == len(numbers)
+        assert stats.mean == pytest.approx(statistics.fmean(numbers))
+        assert stats.variance == pytest.approx(statistics.pvariance(numbers))
+        assert stats.sample_variance == pytest.approx(
+            statistics.variance(numbers))
+        assert stats.min == min(numbers)
+        assert stats.max == max(numbers)
+
+    def test_update_with_buffers(self, numbers):
+        from_list = math.RunningStats(numbers)
+        from_array = math.RunningStats(array('d', numbers))
+
+        assert from_list.mean == from_array.mean
+        assert from_list.variance == from_array.variance
+
+        ints = math.RunningStats(array('i', [1, 2, 3, 4, 5]))
+        assert (ints.mean, ints.variance, ints.min, ints.max) == (3, 2, 1, 5)
+
+    def test_merge(self, numbers):
+        whole = math.RunningStats(numbers)
+        merged = math.RunningStats(numbers[:100])
+        merged.merge(math.RunningStats(numbers[100:3000]))
+        merged.merge(math.RunningStats())
+        merged.merge(math.RunningStats(numbers[3000:]))
+
+        assert merged.count == whole.count
+        assert merged.mean == pytest.approx(whole.mean)
+        assert merged.variance == pytest.approx(whole.variance)
+        assert (merged.min, merged.max) == (whole.min, whole.max)
+
+    def test_empty(self):
+        stats = math.RunningStats()
+        stats.update([])
+        assert stats.count == 0
+        assert isnan(stats.mean)
+        assert isnan(stats.variance)
+        assert isnan(stats.min)
+
+        stats.add(4)
+        assert isnan(stats.sample_variance)
+        assert stats.variance == 0
+
+    def test_pickle(self, numbers):
+        stats = math.RunningStats(numbers)
+        copy = pickle.loads(pickle.dumps(stats))
+
+        assert copy.count == stats.count
+        assert copy.mean == stats.mean
+        assert copy.variance == stats.variance
+        assert (copy.min, copy.max) == (stats.min, stats.max)
+
+    def test_reduce_across_processes(self, numbers):
+        shards = [numbers[i:i + 1000] for i in range(0, len(numbers), 1000)]
+        with ProcessPoolExecutor(2) as pool:
+            merged = functools.reduce(math.RunningStats.merge,
+                                      pool.map(shard_stats, shards))
+
+        assert merged.count == len(numbers)
+        assert merged.mean == pytest.approx(statistics.fmean(numbers))
+
+    def test_invalid_input(self):
+        with pytest.raises(TypeError):
+            math.RunningStats('some random string')
+
+
+class TestRolling:
+    @pytest.fixture
+    def numbers(self):
+        random.seed(13)
+        return [random.uniform(-100, 100) for i in range(2000)]
+
+    @pytest.mark.parametrize('window', [1, 2, 7, 50, 2000])
+    def test_matches_slicing(self, numbers, window):
+        windows = [numbers[i:i + window]
+                   for i in range(len(numbers) - window + 1)]
+
+        means = math.rolling(numbers, window)
+        assert means.typecode == 'd'
+        assert list(means) == pytest.approx(
+            [math.average(w) for w in windows])
+        assert list(math.rolling(numbers, window, 'sum')) == pytest.approx(
+            [fsum(w) for w in windows])
+        assert list(math.rolling(numbers, window, 'min')) == [
+            min(w) for w in windows]
+        assert list(math.rolling(numbers, window, 'max')) == [
+            max(w) for w in windows]
+
+    def test_ewma(self):
+        numbers = [4, 1, 3, 2]
+        expected, ewma = [], None
+        for number in numbers:
+            ewma = number if ewma is None else ewma + 0.5 * (number - ewma)
+            expected.append(ewma)
+
+        assert list(math.rolling(numbers, 1, 'ewma', 0.5)) == expected
+        assert list(math.rolling(numbers, 3, 'ewma', 0.5)) == expected[2:]
+
+    def test_buffers(self):
+        numbers = array('i', [5, 4, 3, 2, 1, 9])
+        assert list(math.rolling(numbers, 3, 'min')) == [3, 2, 1, 1]
+        assert list(math.rolling(memoryview(numbers), 3, 'max')) == [
+            5, 4, 3, 9]
+
+    def test_short_input(self):
+        assert len(math.rolling([1, 2], 3)) == 0
+        assert len(math.rolling([], 3)) == 0
+
+    def test_sum_does_not_drift(self):
+        numbers = array('d', [1e8, 0.1, -1e8, 0.1]) * 50000
+        sums = math.rolling(numbers, 4, 'sum')
+        assert max(abs(s - 0.2) for s in sums) < 1e-15
+
+    def test_window(self, numbers):
+        window = math.RollingWindow(10)
+        for i, number in enumerate(numbers):
+            window.add(number)
+            recent = numbers[max(i - 9, 0):i + 1]
+            assert len(window) == len(recent)
+            assert window.mean == pytest.approx(statistics.fmean(recent))
+            assert (window.min, window.max) == (min(recent), max(recent))
+
+        assert window.seen == len(numbers)
+        assert window.alpha == pytest.approx(2 / 11)
+
+    def test_window_update(self, numbers):
+        one_by_one = math.RollingWindow(25)
+        for number in numbers:
+            one_by_one.add(number)
+        batched = math.RollingWindow(25)
+        batched.update(numbers[:1000])
+        batched.update(array('d', numbers[1000:]))
+
+        assert batched.sum == one_by_one.sum
+        assert batched.ewma == one_by_one.ewma
+        assert (batched.min, batched.max) == (one_by_one.min, one_by_one.max)
+
+    def test_empty_window(self):
+        window = math.RollingWindow(5)
+        assert window.sum == 0
+        assert isnan(window.mean)
+        assert isnan(window.min)
+        assert isnan(window.ewma)
+
+        window.update([1, 2])
+        window.clear()
+        assert len(window) == 0
+        assert isnan(window.max)
+
+    def test_invalid_input(self):
+        with pytest.raises(TypeError):
+            math.rolling([1, 2, 3], 1.5)
+        with pytest.raises(ValueError):
+            math.rolling([1, 2, 3], 0)
+        with pytest.raises(ValueError):
+            math.rolling([1, 2, 3], 2, 'median')
+        with pytest.raises(ValueError):
+            math.RollingWindow(3, alpha=0)
+        with pytest.raises(TypeError):
+            math.RollingWindow(3).update('some random string')
+
+
+def shard_digest(numbers):
+    digest = math.TDigest()
+    digest.update(numbers)
+    return digest
+
+
+class TestTDigest:
+    quantiles = [0.001, 0.01, 0.1, 0.5, 0.9, 0.99, 0.999]
+
+    @pytest.fixture
+    def numbers(self):
+        random.seed(17)
+        return array('d', [random.expovariate(1) for i in range(10**5)])
+
+    def rank_error(self, numbers, digest):
+        ordered = sorted(numbers)
+        return max(abs(bisect_left(ordered, digest.quantile(q)) /
+                       len(ordered) - q) for q in self.quantiles)
+
+    def test_quantiles(self, numbers):
+        digest = math.TDigest()
+        digest.update(numbers)
+
+        assert digest.count == len(numbers)
+        assert (digest.min, digest.max) == (min(numbers), max(numbers))
+        assert digest.quantile(0) == min(numbers)
+        assert digest.quantile(1) == max(numbers)
+        assert self.rank_error(numbers, digest) < 0.002
+
+    def test_bounded_memory(self, numbers):
+        digest = math.TDigest(50)
+        for _ in range(5):
+            digest.update(numbers)
+        assert len(digest) <= 50
+        assert len(digest.to_bytes()) < 50 * 16 + 64
+
+    def test_small_streams_are_exact(self):
+        digest = math.TDigest()
+        digest.update([9, 1, 8, 2, 7, 3, 6, 4, 5])
+        assert len(digest) == 9
+        assert digest.quantiles([0, 0.5, 1]) == [1, 5, 9]
+
+    def test_add_matches_update(self, numbers):
+        one_by_one = math.TDigest()
+        for number in numbers:
+            one_by_one.add(number)
+        batched = math.TDigest()
+        batched.update(numbers)
+
+        assert one_by_one.centroids == batched.centroids
+
+    def test_buffers_and_iterables(self):
+        from_array = math.TDigest()
+        from_array.update(array('i', range(1000)))
+        from_range = math.TDigest()
+        from_range.update(range(1000))
+
+        assert from_array.centroids == from_range.centroids
+        assert from_range.quantile(0.5) == pytest.approx(499.5, abs=1)
+
+    def test_merge(self, numbers):
+        merged = math.TDigest()
+        for i in range(0, len(numbers), 10000):
+            merged.merge(shard_digest(numbers[i:i + 10000]))
+
+        assert merged.count == len(numbers)
+        assert (merged.min, merged.max) == (min(numbers), max(numbers))
+        assert self.rank_error(numbers, merged) < 0.003
+
+    def test_merge_with_itself(self, numbers):
+        digest = shard_digest(range(1000))
+        digest.merge(digest)
+        assert digest.count == 2000
+        assert (digest.min, digest.max) == (0, 999)
+        assert digest.quantile(0.5) == pytest.approx(499.5, abs=5)
+
+        digest = shard_digest(numbers)
+        doubled = shard_digest(numbers)
+        doubled.merge(shard_digest(numbers))
+        digest.merge(digest)
+        assert digest.count == 2 * len(numbers)
+        assert digest.quantiles(self.quantiles) == pytest.approx(
+            doubled.quantiles(self.quantiles), rel=0.01)
+
+    def test_serialisation(self, numbers):
+        digest = shard_digest(numbers)
+        copy = math.TDigest.from_bytes(digest.to_bytes())
+
+        assert copy.compression == digest.compression
+        assert copy.count == digest.count
+        assert copy.centroids == digest.centroids
+        assert copy.quantiles(self.quantiles) == digest.quantiles(
+            self.quantiles)
+
+        pickled = pickle.loads(pickle.dumps(digest))
+        assert pickled.centroids == digest.centroids
+
+    def test_reduce_across_processes(self, numbers):
+        shards = [numbers[i:i + 25000] for i in range(0, len(numbers), 25000)]
+        with ProcessPoolExecutor(2) as pool:
+            merged = functools.reduce(math.TDigest.merge,
+                                      pool.map(shard_digest, shards))
+
+        assert merged.count == len(numbers)
+        assert self.rank_error(numbers, merged) < 0.003
+
+    def test_infinities(self):
+        inf = float('inf')
+        digest = shard_digest([1, 2, inf])
+        assert digest.quantile(0.5) == 2
+        assert digest.quantile(1) == inf
+
+        digest = shard_digest(list(range(10000)) + [inf] * 50 + [-inf] * 50)
+        estimates = digest.quantiles([0, 0.001, 0.5, 0.999, 1])
+        assert estimates[0] == -inf
+        assert estimates[2] == pytest.approx(5000, rel=0.01)
+        assert estimates[-1] == inf
+        assert not any(isnan(estimate) for estimate in estimates)
+
+    def test_empty(self):
+        digest = math.TDigest()
+        digest.update([float('nan')])
+        assert digest.count == 0
+        assert isnan(digest.quantile(0.5))
+        assert isnan(digest.min)
+        assert math.TDigest.from_bytes(digest.to_bytes()).count == 0
+
+    def test_invalid_input(self):
+        digest = math.TDigest()
+        with pytest.raises(ValueError):
+            digest.quantile(1.5)
+        with pytest.raises(ValueError):
+            math.TDigest(compression=1)
+        with pytest.raises(TypeError):
+            math.TDigest(compression='100')
+        with pytest.raises(ValueError):
+            math.TDigest.from_bytes(b'not a digest')
+        with pytest.raises(ValueError):
+            math.TDigest.from_bytes(digest.to_bytes() + b'extra')
+
+
+def test_prime_count_small_numbers():
+    primes = math.sieve_of_erosthenes(100000)
+    counts = [0] * 100001
+    for prime in primes:
+        counts[prime] = 1
+    for n in range(1, 100001):
+        counts[n] += counts[n - 1]
+
+    for n in list(range(0, 3000)) + list(range(3000, 100001, 97)):
+        assert math.prime_count(n) == counts[n]
+
+
+@pytest.mark.parametrize('n, expected', [
+    (10**6, 78498),
+    (10**9, 50847534),
+    (2**32, 203280221),
+    (10**12, 37607912018),
+])
+def test_prime_count_known_values(n, expected):
+    assert math.prime_count(n) == expected
+
+
+def test_prime_count_matches_sieve_around_squares():
+    # The method changes what it does at squares and fourth powers
+    for root in [97, 101, 317, 1009]:
+        for n in [root**2 - 1, root**2, root**2 + 1]:
+            assert math.prime_count(n) == len(math.packed_sieve(n))
+
+
+def test_prime_count_invalid_input():
+    with pytest.raises(TypeError):
+        math.prime_count(5.5)
+    with pytest.raises(ValueError):
+        math.prime_count(-3)
+    with pytest.raises(ValueError):
+        math.prime_count(2**63)
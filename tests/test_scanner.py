@@ -1,5 +1,31 @@
+import re
+import pickle
+import asyncio
 import pytest
-from utils.scanner import StringScanner
+from io import StringIO
+from utils.scanner import (StringScanner, StreamScanner, BytesScanner,
+                           PatternCache, Lexer, LexError, Token, Parser,
+                           ParseError, rule, MemoTable, LRUMemoTable,
+                           WindowMemoTable, TokenArray, AsyncScanner)
+
+
+@pytest.fixture(autouse=True, params=['compiled', 'pure-python'])
+def scanner_core(request, monkeypatch):
+    """
+    Run every test against both the compiled and the pure-Python versions of
+    the scanner's hot methods.
+    """
+    core = StringScanner.__mro__[1]
+    compiled = core.getch.__module__ == 'utils._scanner'
+
+    if request.param == 'compiled' and not compiled:
+        pytest.skip('utils._scanner has not been built')
+    if request.param == 'pure-python' and compiled:
+        # Fall back to the pure-Python methods of the core's base class
+        for name in ('search', 'getch', 'peek', 'current_char',
+                     'end_of_string'):
+            monkeypatch.delattr(core, name)
+    return request.param
 
 
 @pytest.fixture
@@ -52,6 +78,109 @@ class TestScanner:
         assert scanner.pos == 0
         assert scanner.match == None
 
+    def test_mark_and_reset(self, scanner):
+        scanner.scan(r'\w+')
+        mark = scanner.mark()
+        scanner.scan(r', ')
+        scanner.scan(r'\w+')
+        assert scanner.pos == 12
+        scanner.reset(mark)
+        assert scanner.pos == 5
+        assert scanner.match == 'Hello'
+        with pytest.raises(IndexError):
+            scanner.reset(mark)
+
+    def test_reset_invalid_checkpoint(self, scanner):
+        with pytest.raises(IndexError, match='No such checkpoint'):
+            scanner.reset()
+
+        first = scanner.mark()
+        scanner.scan(r'\w+')
+        scanner.mark()
+        scanner.scan(r', ')
+        with pytest.raises(IndexError, match='No such checkpoint'):
+            scanner.reset(-2)
+        with pytest.raises(IndexError, match='No such checkpoint'):
+            scanner.reset(2)
+        assert scanner.pos == 7
+
+        scanner.reset(first)
+        assert scanner.pos == 0
+
+    def test_nested_marks(self, scanner):
+        outer = scanner.mark()
+        scanner.scan(r'\w+')
+        inner = scanner.mark()
+        scanner.scan(r', ')
+        scanner.commit(inner)
+        scanner.scan(r'\w+')
+        scanner.reset(outer)
+        assert scanner.pos == 0
+        assert scanner.match == None
+
+    def test_commit_keeps_position(self, scanner):
+        scanner.mark()
+        scanner.scan(r'\w+')
+        scanner.commit()
+        assert scanner.pos == 5
+        with pytest.raises(IndexError):
+            scanner.commit()
+
+    def test_attempt_rewinds_on_error(self, scanner):
+        with pytest.raises(SyntaxError):
+            with scanner.attempt():
+                scanner.scan(r'\w+')
+                raise SyntaxError
+        assert scanner.pos == 0
+        assert scanner.match == None
+
+    def test_attempt_success(self, scanner):
+        with scanner.attempt():
+            scanner.scan(r'\w+')
+        assert scanner.pos == 5
+        scanner.mark()
+        scanner.reset()
+        assert scanner.pos == 5
+
+    def test_marks_survive_compaction(self):
+        scanner = StringScanner('Hello', compact=True)
+        mark = scanner.mark()
+        scanner.scan(r'\w+')
+        scanner.check(r'\s')
+        scanner.append(', world!')
+        assert scanner.scan(r', \w+') == ', world'
+        scanner.reset(mark)
+        assert scanner.scan(r'\w+') == 'Hello'
+
+    def test_line_col(self):
+        scanner = StringScanner('ab\ncd\n\nef')
+        assert scanner.line_col() == (1, 1)
+        assert scanner.line_col(1) == (1, 2)
+        assert scanner.line_col(2) == (1, 3)
+        assert scanner.line_col(3) == (2, 1)
+        assert scanner.line_col(6) == (3, 1)
+        assert scanner.line_col(8) == (4, 2)
+        scanner.scan(r'ab\nc')
+        assert scanner.line_col() == (2, 2)
+
+    def test_line_col_after_append(self):
+        scanner = StringScanner('ab\n')
+        assert scanner.line_col(3) == (2, 1)
+        scanner.append('cd\nef')
+        assert scanner.line_col(6) == (3, 1)
+        assert scanner.line_col(1) == (1, 2)
+
+    def test_line_col_after_compaction(self):
+        scanner = StringScanner('a\nb\nc', compact=True)
+        scanner.scan(r'a\nb\n')
+        scanner.check(r'x')
+        scanner.append('d\ne')
+        assert scanner.text == 'cd\ne'
+        assert scanner.line_col() == (3, 1)
+        assert scanner.line_col(8) == (4, 2)
+        with pytest.raises(IndexError):
+            scanner.line_col(1)
+
     def test_getch(self, scanner):
         first_char = scanner.getch()
         assert scanner.pos == 1
@@ -71,6 +200,107 @@ class TestScanner:
         assert scanner.pos == old_pos
         assert scanner.match == old_match
 
+    def test_many_appends(self, scanner):
+        for i in range(5):
+            scanner.append(str(i))
+        assert scanner.text == 'Hello, world!01234'
+        assert scanner.scan(r'[\w, !]+') == 'Hello, world!01234'
+
+    def test_compacting_append(self):
+        scanner = StringScanner('Hello', compact=True)
+        scanner.scan(r'\w+')
+        scanner.check(r'\s')
+        scanner.append(', world!')
+        assert scanner.text == ', world!'
+        assert scanner.pos == 5
+        assert scanner.rest == ', world!'
+        assert scanner[5:7] == ', '
+        assert scanner[-1] == '!'
+        assert repr(scanner) == '<StringScanner: position=5 text=", world!">'
+        with pytest.raises(IndexError):
+            scanner[0]
+
+    def test_compacting_append_keeps_match(self):
+        scanner = StringScanner('Hello', compact=True)
+        scanner.scan(r'\w+')
+        scanner.skip(r'\s*')
+        scanner.append(' world')
+        scanner.scan(r'\s+')
+        scanner.unscan()
+        assert scanner.scan(r'\s+\w+') == ' world'
+
+    @pytest.fixture
+    def appended(self):
+        # Appending makes the next read of the text compact it, moving the
+        # offset of everything after the scan pointer
+        scanner = StringScanner('abcd', compact=True)
+        scanner.scan('ab')
+        scanner.scan('c')
+        scanner.append('ef')
+        return scanner
+
+    def test_end_of_string_after_compacting_append(self):
+        scanner = StringScanner('abcdefgh', compact=True)
+        scanner.scan('abcd')
+        scanner.scan('e')
+        scanner.append('z')
+        assert not scanner.end_of_string
+        assert scanner.rest == 'fghz'
+
+    def test_peek_after_compacting_append(self, appended):
+        assert appended.peek() == 'e'
+
+    def test_current_char_after_compacting_append(self, appended):
+        assert appended.current_char == 'd'
+
+    def test_getch_after_compacting_append(self, appended):
+        assert appended.getch() == 'd'
+        assert appended.getch() == 'e'
+
+    def test_lexer_after_compacting_append(self):
+        scanner = StringScanner('abcdefgh', compact=True)
+        scanner.scan('abcd')
+        scanner.scan('e')
+        scanner.append('z')
+        lexer = Lexer([('W', '[a-z]')])
+        assert [t.value for t in lexer.tokenize(scanner)] == list('fghz')
+
+    def test_caret_matches_at_the_scan_pointer(self):
+        scanner = StringScanner('ab cd')
+        scanner.scan('a')
+        assert scanner.scan('^b') == 'b'
+        assert scanner.check('^b') is None
+        assert scanner.skip('^ ') == 1
+        assert scanner.pos == 3
+
+    def test_start_of_string_matches_at_the_scan_pointer(self):
+        scanner = StringScanner('ab cd')
+        scanner.scan('a')
+        assert scanner.check(r'\Ab') == 'b'
+        assert scanner.scan(r'\Ab') == 'b'
+        assert scanner.scan_until(r'\Ac') is None
+        assert scanner.scan_until(r'\A c') == ' c'
+        assert scanner.pos == 4
+
+    def test_lookbehind_can_not_see_scanned_text(self):
+        scanner = StringScanner('xaxa')
+        scanner.scan('x')
+        assert scanner.scan('(?<!x)a') == 'a'
+        assert scanner.scan('(?<=a)x') is None
+        assert scanner.scan(r'\bx') == 'x'
+
+    def test_lookbehind_after_compacting_append(self):
+        scanner = StringScanner('abc', compact=True)
+        scanner.scan('abc')
+        scanner.append('def')
+        assert scanner.scan('^de') == 'de'
+        assert scanner.scan('(?<!e)f') == 'f'
+
+    def test_caret_in_bytes_scanner(self):
+        scanner = BytesScanner(b'ab cd')
+        scanner.scan(b'a')
+        assert scanner.scan(b'^b') == b'b'
+
     def test_not_at_eos(self, scanner):
         assert scanner.pos == 0
         assert len(scanner.text) > 0
@@ -131,3 +361,709 @@ class TestScanner:
         old_pos = scanner.pos
         assert scanner.rest == ', world!'
         assert scanner.pos == old_pos
+
+    def test_scan_after_advancing(self, scanner):
+        scanner.scan(r'\w+')
+        assert scanner.scan(r'\w+') == None
+        assert scanner.scan(r', ') == ', '
+        assert scanner.scan(r'\w+') == 'world'
+        assert scanner.pos == 12
+
+    def test_search_not_from_pointer(self, scanner):
+        scanner.scan(r'\w+')
+        num_skipped = scanner.search(r'o', return_string=False,
+                                     from_pointer=False)
+        assert num_skipped == 4
+        assert scanner.match == ', wo'
+        assert scanner.pos == 9
+
+    def test_scan_until(self, scanner):
+        assert scanner.scan_until(r'o') == 'Hello'
+        assert scanner.pos == 5
+        assert scanner.pre_match == 'Hell'
+        assert scanner.scan_until(r'o') == ', wo'
+        assert scanner.pre_match == ', w'
+        assert scanner.scan_until(r'z') == None
+        assert scanner.pre_match == None
+        assert scanner.pos == 9
+
+    def test_skip_until(self, scanner):
+        assert scanner.skip_until(r'w') == 8
+        assert scanner.pos == 8
+        assert scanner.match == 'Hello, w'
+        assert scanner.pre_match == 'Hello, '
+        assert scanner.skip_until(r'z') == 0
+        assert scanner.match == None
+
+    def test_check_until(self, scanner):
+        assert scanner.check_until(r',') == 'Hello,'
+        assert scanner.pos == 0
+        assert scanner.match == 'Hello,'
+
+    def test_exist(self, scanner):
+        assert scanner.exist(r'w') == 8
+        assert scanner.pos == 0
+        assert scanner.exist(r'z') == None
+        assert scanner.exist(r'H') == 1
+
+    def test_iter_matches(self, scanner):
+        assert list(scanner.iter_matches(r'\w+')) == ['Hello', 'world']
+        assert scanner.pos == 12
+        assert scanner.match == 'world'
+
+    def test_iter_matches_limit(self, scanner):
+        assert list(scanner.iter_matches(r'o', limit=1)) == ['o']
+        assert scanner.pos == 5
+        assert list(scanner.iter_matches(r'o', limit=5)) == ['o']
+        assert scanner.pos == 9
+
+    def test_iter_matches_without_advancing(self, scanner):
+        scanner.skip(r'\w+')
+        assert list(scanner.iter_matches(r'l', advance=False)) == ['l']
+        assert scanner.pos == 5
+        assert scanner.match == 'l'
+
+    def test_iter_matches_closed_early(self, scanner):
+        matches = scanner.iter_matches(r'l')
+        next(matches)
+        next(matches)
+        matches.close()
+        assert scanner.pos == 4
+
+    def test_iter_matches_nothing_found(self, scanner):
+        assert list(scanner.iter_matches(r'\d')) == []
+        assert scanner.pos == 0
+        assert scanner.match == None
+
+    def test_iter_matches_empty_matches(self, scanner):
+        expected = re.findall(r'\b|o', scanner.text)
+        assert list(scanner.iter_matches(r'\b|o')) == expected
+
+    def test_unscan_after_skip_until(self, scanner):
+        scanner.skip(r'\w+')
+        scanner.skip_until(r'!')
+        scanner.unscan()
+        assert scanner.pos == 5
+
+    def test_pre_match_after_scan(self, scanner):
+        scanner.scan(r'\w+')
+        assert scanner.pre_match == ''
+        scanner.getch()
+        assert scanner.pre_match == None
+
+    def test_precompiled_pattern(self, scanner):
+        assert scanner.scan(re.compile(r'hello', re.IGNORECASE)) == 'Hello'
+        assert scanner.pos == 5
+
+
+class TestPatternCache:
+    def test_hits_and_misses(self):
+        cache = PatternCache(maxsize=10)
+        first = cache.compile(r'\w+')
+        second = cache.compile(r'\w+')
+        assert first is second
+        assert cache.misses == 1
+        assert cache.hits == 1
+        assert len(cache) == 1
+
+    def test_lru_eviction(self):
+        cache = PatternCache(maxsize=2)
+        cache.compile('a')
+        cache.compile('b')
+        cache.compile('a')
+        cache.compile('c')
+        assert len(cache) == 2
+        cache.compile('a')
+        assert cache.info().hits == 2
+        cache.compile('b')
+        assert cache.info().misses == 4
+
+    def test_compiled_patterns_bypass_cache(self):
+        cache = PatternCache()
+        regex = re.compile('a')
+        assert cache.compile(regex) is regex
+        assert len(cache) == 0
+        assert cache.misses == 0
+
+    def test_resize_and_clear(self):
+        cache = PatternCache(maxsize=None)
+        cache.compile('a')
+        cache.resize(5)
+        assert cache.maxsize == 5
+        assert len(cache) == 0
+        cache.compile('a')
+        cache.clear()
+        assert len(cache) == 0
+        assert cache.misses == 0
+
+    def test_invalid_size(self):
+        with pytest.raises(ValueError):
+            PatternCache(maxsize=-1)
+
+    def test_scanner_uses_cache(self, scanner, monkeypatch):
+        cache = PatternCache()
+        monkeypatch.setattr(StringScanner, 'pattern_cache', cache)
+        scanner.scan(r'\w+')
+        scanner.check(r'\w+')
+        assert cache.misses == 1
+        assert cache.hits == 1
+
+
+class TestBytesScanner:
+    @pytest.fixture(params=['bytes', 'bytearray', 'memoryview', 'mmap'])
+    def scanner(self, request, tmp_path):
+        src = b'Hello, world!'
+        if request.param == 'mmap':
+            filename = tmp_path / 'hello.txt'
+            filename.write_bytes(src)
+            scanner = BytesScanner.from_file(str(filename))
+        elif request.param == 'bytes':
+            scanner = BytesScanner(src)
+        elif request.param == 'bytearray':
+            scanner = BytesScanner(bytearray(src))
+        else:
+            scanner = BytesScanner(memoryview(src))
+        yield scanner
+        scanner.close()
+
+    def test_scan(self, scanner):
+        assert scanner.scan(rb'\w+') == b'Hello'
+        assert isinstance(scanner.match, memoryview)
+        assert scanner.pos == 5
+        assert scanner.skip(rb',\s+') == 2
+        assert scanner.check(rb'\w+') == b'world'
+        assert scanner.pos == 7
+
+    def test_failed_scan(self, scanner):
+        assert scanner.scan(rb'\d+') == None
+        assert scanner.pos == 0
+
+    def test_getch_and_peek(self, scanner):
+        assert scanner.getch() == b'H'
+        assert scanner.current_char == b'e'
+        assert scanner.peek(3) == b'llo'
+
+    def test_rest_is_a_view(self, scanner):
+        scanner.scan(rb'\w+')
+        rest = scanner.rest
+        assert isinstance(rest, memoryview)
+        assert rest == b', world!'
+        rest.release()
+
+    def test_end_of_string(self, scanner):
+        scanner.scan(rb'.*')
+        assert scanner.end_of_string
+        assert scanner.current_char == None
+
+    def test_getitem(self, scanner):
+        assert scanner[0] == ord('H')
+        assert scanner[7:12] == b'world'
+
+    def test_repr(self, scanner):
+        should_be = "<BytesScanner: position=0 text=b'Hello, world!'>"
+        assert repr(scanner) == should_be
+
+    def test_append(self):
+        scanner = BytesScanner(b'abc')
+        scanner.scan(rb'ab')
+        scanner.append(b'def')
+        assert scanner.rest == b'cdef'
+
+    def test_line_col(self):
+        scanner = BytesScanner(b'ab\ncd')
+        assert scanner.line_col(4) == (2, 2)
+
+    def test_empty_file(self, tmp_path):
+        filename = tmp_path / 'empty.txt'
+        filename.write_bytes(b'')
+        with BytesScanner.from_file(str(filename)) as scanner:
+            assert scanner.end_of_string
+
+
+class TestStreamScanner:
+    @pytest.fixture
+    def scanner(self):
+        return StreamScanner(StringIO('Hello, world!'), chunk_size=3,
+                             lookahead=8)
+
+    def test_scan_across_chunks(self, scanner):
+        assert scanner.scan(r'\w+') == 'Hello'
+        assert scanner.pos == 5
+        assert scanner.skip(r',\s*') == 2
+        assert scanner.scan(r'\w+') == 'world'
+        assert scanner.getch() == '!'
+        assert scanner.end_of_string
+
+    def test_iterable_of_chunks(self):
+        scanner = StreamScanner(['ab', '', 'cd', 'ef'], lookahead=1)
+        assert scanner.scan(r'[a-e]+') == 'abcde'
+        assert scanner.current_char == 'f'
+
+    def test_check_and_unscan(self, scanner):
+        assert scanner.check(r'\w+,') == 'Hello,'
+        assert scanner.pos == 0
+        scanner.scan(r'\w+,')
+        scanner.unscan()
+        assert scanner.pos == 0
+        assert scanner.scan(r'\w+') == 'Hello'
+
+    def test_failed_match(self, scanner):
+        assert scanner.scan(r'\d+') == None
+        assert scanner.pos == 0
+
+    def test_iter_matches_across_chunks(self, scanner):
+        assert list(scanner.iter_matches(r'\w+')) == ['Hello', 'world']
+        assert scanner.pos == 12
+        assert scanner.match == 'world'
+
+    def test_iter_matches_empty_matches_across_chunks(self):
+        text = 'ab cd  efg h'
+        scanner = StreamScanner([text[i:i + 2] for i in range(0, 12, 2)],
+                                lookahead=1)
+        expected = re.findall(r'\b|\s*', text)
+        assert list(scanner.iter_matches(r'\b|\s*')) == expected
+
+    def test_search(self, scanner):
+        assert scanner.search(r'!', from_pointer=False) == 'Hello, world!'
+        assert scanner.end_of_string
+
+    def test_peek_and_getitem(self, scanner):
+        assert scanner.peek(4) == 'ello'
+        assert scanner[7:12] == 'world'
+        assert scanner[-1] == '!'
+
+    def test_rest(self, scanner):
+        scanner.scan(r'\w+')
+        assert scanner.rest == ', world!'
+
+    def test_skip_until(self, scanner):
+        assert scanner.skip_until(r'wor') == 10
+        assert scanner.pre_match == 'Hello, '
+        assert scanner.match == 'Hello, wor'
+        scanner.unscan()
+        assert scanner.pos == 0
+
+    def test_consumed_text_is_discarded(self):
+        chunks = ('word{} '.format(i) for i in range(10000))
+        scanner = StreamScanner(chunks, chunk_size=64, lookahead=16)
+        words = 0
+        while not scanner.end_of_string:
+            scanner.skip(r'\s+')
+            if scanner.scan(r'\w+'):
+                words += 1
+            assert len(scanner.text) < 200
+
+        assert words == 10000
+        with pytest.raises(IndexError):
+            scanner[0]
+
+    def test_line_col(self):
+        lines = ('line {}\n'.format(i) for i in range(1000))
+        scanner = StreamScanner(lines, lookahead=8)
+        while scanner.skip(r'line \d+\n'):
+            pass
+        scanner.check(r'x')
+        assert scanner.line_col(scanner.pos - 4) == (1000, 6)
+        assert scanner.line_col() == (1001, 1)
+
+    def test_lexer_on_stream(self):
+        lexer = Lexer([('NUMBER', r'\d+'), ('NAME', r'[a-z]+'),
+                       ('SPACE', r'\s+', Lexer.SKIP)], track_lines=True)
+        text = '\n'.join('abc{} {}'.format(i, i * 7) for i in range(500))
+        chunks = (text[i:i + 7] for i in range(0, len(text), 7))
+
+        streamed = list(lexer.tokenize(StreamScanner(chunks, lookahead=3)))
+        assert streamed == list(lexer.tokenize(text))
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def scan_chunks(handler, *chunks, **kwargs):
+    """
+    Feed some chunks of data to an `AsyncScanner` (with a pause between
+    each one) and run a coroutine function against it.
+    """
+    async def main():
+        reader = asyncio.StreamReader()
+        scanner = AsyncScanner(reader, **kwargs)
+        task = asyncio.ensure_future(handler(scanner))
+        for chunk in chunks:
+            await asyncio.sleep(0)
+            reader.feed_data(chunk)
+        await asyncio.sleep(0)
+        reader.feed_eof()
+        return await task
+
+    return run(main())
+
+
+class TestAsyncScanner:
+    def test_scan_across_chunks(self):
+        async def handler(scanner):
+            word = await scanner.scan(rb'\w+')
+            space = await scanner.skip(rb'\s+')
+            rest = await scanner.scan_until(rb'!')
+            return word, space, rest, scanner.pos, await scanner.at_eof()
+
+        got = scan_chunks(handler, b'Hel', b'lo  wo', b'rld', b'!')
+        assert got == (b'Hello', 2, b'world!', 13, True)
+
+    def test_failed_match_waits_for_lookahead(self):
+        async def handler(scanner):
+            return await scanner.scan(rb'\d+'), await scanner.scan(rb'ab\w+')
+
+        got = scan_chunks(handler, b'a', b'bc', b'de', lookahead=3)
+        assert got == (None, b'abcde')
+
+    def test_lookahead_waits_for_data(self):
+        async def handler(scanner):
+            return await scanner.check(rb'(?=HELLO)'), scanner.pos
+
+        assert scan_chunks(handler, b'HEL', b'LO') == (b'', 0)
+
+    def test_negative_lookahead_at_end_of_buffer(self):
+        async def handler(scanner):
+            return await scanner.scan(rb'foo(?!bar)'), await scanner.scan(
+                rb'\w+')
+
+        assert scan_chunks(handler, b'foo', b'bar') == (None, b'foobar')
+        assert scan_chunks(handler, b'foo', b'baz') == (b'foo', b'baz')
+
+    def test_end_anchor_waits_for_data(self):
+        async def handler(scanner):
+            return await scanner.scan(rb'ab$'), await scanner.scan(rb'\w+')
+
+        assert scan_chunks(handler, b'ab', b'cd') == (None, b'abcd')
+
+    def test_search_reads_until_found(self):
+        async def handler(scanner):
+            skipped = await scanner.skip_until(rb';')
+            return skipped, scanner.pre_match, await scanner.exist(rb'x')
+
+        got = scan_chunks(handler, b'abc', b'def', b';ghi')
+        assert got == (7, b'abcdef', None)
+
+    def test_search_at_eof(self):
+        async def handler(scanner):
+            return await scanner.scan_until(rb';'), await scanner.at_eof()
+
+        assert scan_chunks(handler, b'abc') == (None, False)
+
+    def test_check_and_unscan(self):
+        async def handler(scanner):
+            checked = await scanner.check(rb'\w+')
+            await scanner.scan(rb'\w+')
+            scanner.unscan()
+            return checked, scanner.pos
+
+        assert scan_chunks(handler, b'ab', b'cd ef') == (b'abcd', 0)
+
+    def test_buffer_limit(self):
+        async def handler(scanner):
+            with pytest.raises(asyncio.LimitOverrunError):
+                await scanner.scan_until(rb'\n')
+            return scanner.pos
+
+        assert scan_chunks(handler, b'x' * 10, b'\n', max_buffer=8) == 0
+
+    def test_consumed_data_is_discarded(self):
+        async def handler(scanner):
+            lines = []
+            while not await scanner.at_eof():
+                lines.append(await scanner.scan_until(rb'\n'))
+                assert len(scanner.text) <= 32
+            return lines
+
+        lines = [b'line %d\n' % i for i in range(20)]
+        assert scan_chunks(handler, *lines, max_buffer=16) == lines
+
+    def test_loopback_request_response(self):
+        async def serve(reader, writer):
+            scanner = AsyncScanner(reader)
+            command = None
+            while command != b'QUIT\r\n':
+                command = await scanner.scan_until(rb'\r\n')
+                writer.write(command[:-2].lower() + b'\r\n')
+            writer.close()
+            await writer.wait_closed()
+
+        async def main():
+            server = await asyncio.start_server(serve, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+            # Each reply has to arrive before the next command is sent, so
+            # this would hang if the scanner waited for more than it needs
+            replies = []
+            for command in [b'PING', b'ECHO HELLO', b'QUIT']:
+                writer.write(command + b'\r\n')
+                await writer.drain()
+                replies.append(await asyncio.wait_for(reader.readline(), 5))
+
+            assert await reader.read() == b''
+            writer.close()
+            await writer.wait_closed()
+            server.close()
+            await server.wait_closed()
+            return replies
+
+        assert run(main()) == [b'ping\r\n', b'echo hello\r\n', b'quit\r\n']
+
+
+class TestLexer:
+    @pytest.fixture
+    def lexer(self):
+        return Lexer([
+            ('NUMBER', r'\d+', lambda scanner, text: int(text)),
+            ('NAME', r'\w+'),
+            ('OP', r'[-+*/=]'),
+            ('WHITESPACE', r'\s+', Lexer.SKIP),
+        ])
+
+    def test_compiled_patterns_keep_their_flags(self):
+        lexer = Lexer([
+            ('KW', re.compile('select', re.IGNORECASE)),
+            ('NAME', r'\w+'),
+            ('WHITESPACE', r'\s+', Lexer.SKIP),
+        ])
+        tokens = list(lexer.tokenize('SELECT x'))
+        assert [t.type for t in tokens] == ['KW', 'NAME']
+
+        lexer = Lexer([
+            ('KW', re.compile('select')),
+            ('NAME', r'\w+'),
+            ('WHITESPACE', r'\s+', Lexer.SKIP),
+        ], flags=re.IGNORECASE)
+        tokens = list(lexer.tokenize('SELECT select'))
+        assert [t.type for t in tokens] == ['NAME', 'KW']
+
+    def test_compiled_pattern_with_incompatible_flags(self):
+        with pytest.raises(ValueError):
+            Lexer([('A', re.compile('a', re.ASCII))])
+
+    def test_tokenize(self, lexer):
+        tokens = list(lexer.tokenize('x = 42 + y1'))
+        assert tokens == [
+            Token('NAME', 'x', 0, 1),
+            Token('OP', '=', 2, 3),
+            Token('NUMBER', 42, 4, 6),
+            Token('OP', '+', 7, 8),
+            Token('NAME', 'y1', 9, 11),
+        ]
+
+    def test_tokenize_is_lazy(self, lexer):
+        scanner = StringScanner('a b c')
+        tokens = lexer.tokenize(scanner)
+        assert next(tokens) == Token('NAME', 'a', 0, 1)
+        assert scanner.pos == 1
+        assert scanner.match == 'a'
+
+    def test_track_lines(self):
+        lexer = Lexer([('NAME', r'\w+'), ('SPACE', r'\s+', Lexer.SKIP)],
+                      track_lines=True)
+        tokens = list(lexer.tokenize('a b\n  c\n\nd'))
+        assert [(t.value, t.line, t.column) for t in tokens] == [
+            ('a', 1, 1), ('b', 1, 3), ('c', 2, 3), ('d', 4, 1)]
+
+    def test_rule_order_wins(self):
+        lexer = Lexer([('IF', r'if'), ('NAME', r'[a-z]+')])
+        assert [t.type for t in lexer.tokenize('if')] == ['IF']
+
+    def test_rules_with_groups(self):
+        lexer = Lexer([
+            ('STRING', r'(?P<quote>[\'"]).*?(?P=quote)'),
+            ('PAIR', r'(\w)(\w)'),
+        ])
+        tokens = list(lexer.tokenize('"a"ab'))
+        assert [t.type for t in tokens] == ['STRING', 'PAIR']
+
+    def test_action_can_consume_more(self):
+        def heredoc(scanner, text):
+            return text + scanner.scan(r'[^;]*')
+
+        lexer = Lexer([('DOC', r'<<', heredoc), ('END', r';')])
+        tokens = list(lexer.tokenize('<<abc;'))
+        assert tokens == [Token('DOC', '<<abc', 0, 5), Token('END', ';', 5, 6)]
+
+    def test_strict_errors(self, lexer):
+        with pytest.raises(LexError) as excinfo:
+            list(lexer.tokenize('x = $$ y'))
+        assert excinfo.value.pos == 4
+
+    def test_ignore_errors(self):
+        lexer = Lexer([('NAME', r'\w+'), ('WS', r'\s+', Lexer.SKIP)],
+                      errors='ignore')
+        tokens = list(lexer.tokenize('a $$ b $'))
+        assert [t.value for t in tokens] == ['a', 'b']
+
+    def test_error_tokens(self):
+        lexer = Lexer([('NAME', r'\w+')], errors='token')
+        tokens = list(lexer.tokenize('a$$b'))
+        assert tokens == [
+            Token('NAME', 'a', 0, 1),
+            Token(Lexer.ERROR, '$$', 1, 3),
+            Token('NAME', 'b', 3, 4),
+        ]
+
+    def test_skip_survives_pickling(self):
+        lexer = Lexer([('NAME', r'\w+'), ('SPACE', r'\s+', Lexer.SKIP)])
+        clone = pickle.loads(pickle.dumps(lexer))
+        assert list(clone.tokenize('a 1')) == list(lexer.tokenize('a 1'))
+
+    def test_tokenize_parallel(self):
+        lexer = Lexer([('NUMBER', r'\d+'), ('NAME', r'[a-z]+'),
+                       ('SPACE', r'\s+', Lexer.SKIP)], track_lines=True)
+        text = '\n'.join('abc{} {}'.format(i, i * 7) for i in range(2000))
+
+        tokens = list(lexer.tokenize_parallel(text, chunk_size=500, workers=2))
+        assert tokens == list(lexer.tokenize(text))
+
+    def test_tokenize_parallel_custom_boundary(self):
+        lexer = Lexer([('RECORD', r'[^;]+'), ('END', r';')])
+        text = ';'.join('record {}'.format(i) for i in range(100))
+
+        tokens = list(lexer.tokenize_parallel(text, boundary=';',
+                                              chunk_size=50, workers=2))
+        assert tokens == list(lexer.tokenize(text))
+
+    def test_tokenize_parallel_errors(self):
+        lexer = Lexer([('NAME', r'[a-z]+'), ('SPACE', r'\s+', Lexer.SKIP)])
+        text = 'abc\n' * 100 + '$'
+        with pytest.raises(LexError) as excinfo:
+            list(lexer.tokenize_parallel(text, chunk_size=50, workers=2))
+        assert excinfo.value.pos == 400
+
+    def test_tokenize_compact(self):
+        lexer = Lexer([('NUMBER', r'\d+'), ('NAME', r'\w+'),
+                       ('SPACE', r'\s+', Lexer.SKIP)])
+        text = 'x 42\ny1 7'
+        tokens = lexer.tokenize_compact(text)
+
+        assert isinstance(tokens, TokenArray)
+        assert len(tokens) == 4
+        assert list(tokens) == list(lexer.tokenize(text))
+        assert tokens[1] == Token('NUMBER', '42', 2, 4)
+        assert tokens[-1] == Token('NUMBER', '7', 8, 9)
+        assert tokens[1:3] == [Token('NUMBER', '42', 2, 4),
+                               Token('NAME', 'y1', 5, 7)]
+        assert tokens.type(2) == 'NAME'
+        assert tokens.value(2) == 'y1'
+        assert list(tokens.starts) == [0, 2, 5, 8]
+        assert tokens.types.itemsize <= 2
+
+    def test_tokenize_compact_lines_and_errors(self):
+        lexer = Lexer([('NAME', r'\w+'), ('SPACE', r'\s+', Lexer.SKIP)],
+                      errors='token', track_lines=True)
+        text = 'a $\n b'
+        assert list(lexer.tokenize_compact(text)) == list(lexer.tokenize(text))
+
+    def test_invalid_error_policy(self):
+        with pytest.raises(ValueError):
+            Lexer([('NAME', r'\w+')], errors='blah')
+
+
+class Calculator(Parser):
+    """
+    A deliberately naive grammar which re-tries `term` for every
+    alternative of `expr`.
+    """
+    calls = 0
+
+    @rule
+    def expr(self):
+        return self.choice(self.sum, self.difference, self.term)
+
+    @rule
+    def sum(self):
+        left = self.term()
+        self.expect(r'\+')
+        return left + self.expr()
+
+    @rule
+    def difference(self):
+        left = self.term()
+        self.expect(r'-')
+        return left - self.expr()
+
+    @rule
+    def term(self):
+        self.calls += 1
+        return self.choice(self.number, self.parens)
+
+    @rule
+    def number(self):
+        return int(self.expect(r'\d+'))
+
+    @rule
+    def parens(self):
+        self.expect(r'\(')
+        value = self.expr()
+        self.expect(r'\)')
+        return value
+
+
+class TestParser:
+    def test_parse(self):
+        assert Calculator('1+(2-3)+4').parse('expr') == 4
+
+    def test_memoization(self):
+        parser = Calculator('(((((1)))))')
+        assert parser.parse('expr') == 1
+        # Each term is parsed once per position, instead of 3**depth times
+        assert parser.calls == 6
+
+    def test_failure_rewinds(self):
+        parser = Calculator('1+')
+        with pytest.raises(ParseError):
+            parser.sum()
+        assert parser.scanner.pos == 0
+
+    def test_furthest_error_is_reported(self):
+        with pytest.raises(ParseError) as excinfo:
+            Calculator('1+(2+').parse('expr')
+        assert excinfo.value.pos == 5
+
+    def test_incomplete_parse(self):
+        with pytest.raises(ParseError):
+            Calculator('1)').parse('expr')
+        assert Calculator('1)').parse('expr', complete=False) == 1
+
+    def test_many_and_optional(self):
+        class Words(Parser):
+            @rule
+            def words(self):
+                words = self.many(self.word, minimum=1)
+                self.optional(lambda: self.expect(r'!'))
+                return words
+
+            @rule
+            def word(self):
+                self.many(lambda: self.expect(r'\s+'))
+                return self.expect(r'\w+')
+
+        assert Words('hello big world!').parse('words') == [
+            'hello', 'big', 'world']
+        with pytest.raises(ParseError):
+            Words('!').parse('words')
+
+    def test_lru_memo_table(self):
+        memo = LRUMemoTable(maxsize=3)
+        parser = Calculator('(((((1)))))', memo=memo)
+        assert parser.parse('expr') == 1
+        assert len(memo) == 3
+
+    def test_window_memo_table(self):
+        memo = WindowMemoTable(window=2)
+        for pos in range(100):
+            memo.put('rule', pos, ('result', pos + 1))
+        assert len(memo) <= 7
+        assert memo.get('rule', 99) == ('result', 100)
+        assert memo.get('rule', 0) is None
+        memo.clear()
+        assert len(memo) == 0
@@ -0,0 +1,107 @@
+"""
+Compiled versions of the `StringScanner` methods which get called for every
+token (or character) scanned. See `utils.scanner._ScannerCore` for the
+pure-Python originals, which these have to behave exactly like.
+
+These are plain functions rather than an extension type so that scanners
+stay ordinary Python objects. Subclassing an extension type would make
+every other attribute access on a scanner (e.g. in `Lexer.tokenize()`)
+slower than the compiled methods make up for.
+"""
+
+
+cdef inline object _text(self):
+    if self._pending:
+        # Let the scanner join (and maybe compact) the pending chunks
+        return self.text
+    return self._text
+
+
+def search(self, pattern, advance_pointer=True, return_string=True,
+           from_pointer=True):
+    r"""
+    The function that does most of the heavy lifting.
+
+    The pattern is matched in place, starting at the scan pointer (using
+    the `pos` argument of a compiled pattern), so no copies of the
+    remaining text are made and each call only costs as much as the
+    match itself.
+
+    Note
+    ----
+    Patterns which can look behind where they start (`^`, `\A`, `\b`,
+    `\B` and lookbehind assertions) are matched against a copy of the
+    rest of the text instead (see `StringScanner._find()`), so that the
+    scan pointer behaves like the start of the string.
+    """
+    cdef Py_ssize_t start, end, match_end, base
+
+    regex = self.pattern_cache.compile(pattern)
+    match = self._find(regex, from_pointer)
+    start = self.pos
+
+    if match is not None:
+        base = self._base
+        match_end = match.end()
+        end = base + match_end
+        self._span = (start, base + match.start(), end)
+        if return_string:
+            self._match = match.string[start - base:match_end]
+        else:
+            self._match = None
+    else:
+        end = start
+        self._match = None
+        self._span = None
+
+    if advance_pointer:
+        self.pos = end
+
+    if return_string:
+        return self._match
+    else:
+        return end - start
+
+
+def getch(self):
+    """
+    Get the next character from the string.
+    """
+    character = self.current_char
+    self.pos += 1
+    self._match = character
+    self._span = None
+    return character
+
+
+def peek(self, Py_ssize_t n=1):
+    """
+    Get the next n characters.
+    """
+    cdef Py_ssize_t start
+    # Flushing pending chunks may compact the text and move _base, so the
+    # text has to be fetched before the offset is worked out
+    text = _text(self)
+    start = self.pos - self._base + 1
+    return text[start:start + n]
+
+
+def current_char(self):
+    """
+    Get the current string. If we are at the end of the text, then return
+    None.
+    """
+    cdef Py_ssize_t index
+    text = _text(self)
+    index = self.pos - self._base
+    if index == len(text):
+        return None
+    return text[index]
+
+
+def end_of_string(self):
+    """
+    Check whether the scanner is at the end of the string.
+    """
+    text = _text(self)
+    return self.pos - self._base == len(text)
@@ -1,34 +1,1019 @@
-cpdef double average(list data):
+import os
+import sys
+import struct
+from array import array
+from math import isqrt, log as _log
+from concurrent.futures import ThreadPoolExecutor
+
+cimport cython
+from libc.math cimport fabs, sqrt, asin, sin, M_PI, INFINITY, NAN
+from libc.stdlib cimport qsort
+from libc.string cimport memset
+
+
+ctypedef fused _numeric:
+    double
+    float
+    long long
+    unsigned long long
+    int
+    unsigned int
+    short
+    unsigned short
+    signed char
+    unsigned char
+
+
+# Below this many items pairwise summation just adds them up directly
+cdef enum:
+    _PAIRWISE_BLOCK = 128
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double _sum_naive(const _numeric[:] data) noexcept nogil:
+    cdef:
+        double total = 0
+        Py_ssize_t i
+
+    for i in range(data.shape[0]):
+        total += data[i]
+    return total
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double _sum_kahan(const _numeric[:] data) noexcept nogil:
+    # Neumaier's variant, which also copes with terms bigger than the total
     cdef:
-        double total = 0, i
+        double total = 0, compensation = 0, value, t
+        Py_ssize_t i
 
-    for i in data:
-        total += i
+    for i in range(data.shape[0]):
+        value = data[i]
+        t = total + value
+        if fabs(total) >= fabs(value):
+            compensation += (total - t) + value
+        else:
+            compensation += (value - t) + total
+        total = t
+    return total + compensation
 
-    return total/len(data)
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double _sum_pairwise(const _numeric[:] data) noexcept nogil:
+    cdef:
+        Py_ssize_t n = data.shape[0], half
+        double total = 0
+        Py_ssize_t i
 
-cdef _sieve_of_erosthenes(int n):
+    if n <= _PAIRWISE_BLOCK:
+        for i in range(n):
+            total += data[i]
+        return total
+
+    half = n // 2
+    return _sum_pairwise(data[:half]) + _sum_pairwise(data[half:])
+
+
+def _average(const _numeric[:] data, method):
+    cdef double total
+
+    if method == 'naive':
+        with nogil:
+            total = _sum_naive(data)
+    elif method == 'kahan':
+        with nogil:
+            total = _sum_kahan(data)
+    elif method == 'pairwise':
+        with nogil:
+            total = _sum_pairwise(data)
+    else:
+        raise ValueError('Unknown summation method: {!r}'.format(method))
+
+    return total / data.shape[0]
+
+
+def average(data, method='naive'):
     """
-    A naive implementation of the sieve of erosthenes that returns a list of
-    all primes below `n`. 
+    Get the mean of a sequence of numbers.
 
-    Note that all type and value checking is done by a python wrapper.
+    Anything supporting the buffer protocol with a numeric format (e.g. an
+    `array.array`, a numpy array or a memoryview of either) is read in
+    place, and the sum is done without the GIL. Other iterables are copied
+    into an `array('d')` first.
+
+    Parameters
+    ----------
+    data: buffer or iterable of numbers
+        The numbers to average. Multi-dimensional buffers must be
+        contiguous.
+    method: str
+        How to add everything up:
+
+        - 'naive' adds the numbers one after another, the same as `sum()`.
+        - 'pairwise' recursively adds up each half (like numpy), which is
+          nearly as fast and has an error of O(log n) instead of O(n).
+        - 'kahan' uses compensated summation, which is the most accurate
+          (the error doesn't grow with n) but takes about four times as
+          many floating point operations.
+
+        (default: 'naive')
+    """
+    view = _as_numbers(data)
+    if len(view) == 0:
+        raise ZeroDivisionError('Can not average an empty sequence')
+    return _average(view, method)
+
+
+cdef _as_numbers(data):
+    """
+    Get a flat memoryview of some numbers, using the data in place if it
+    supports the buffer protocol and copying it into an `array('d')` if not.
+    """
+    try:
+        view = memoryview(data)
+    except TypeError:
+        return memoryview(array('d', data))
+
+    if view.ndim != 1:
+        view = view.cast('B').cast(view.format)
+    return view
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _moments(const _numeric[:] data, double *mean, double *m2,
+                   double *lowest, double *highest) noexcept nogil:
+    """
+    Find the mean, sum of squared deviations from the mean, minimum and
+    maximum of a (non-empty) batch of numbers, using two passes for
+    accuracy.
+    """
+    cdef:
+        Py_ssize_t i, n = data.shape[0]
+        double value, total = 0, deviation, squares = 0
+        double low = data[0], high = data[0]
+
+    for i in range(n):
+        value = data[i]
+        total += value
+        if value < low:
+            low = value
+        if value > high:
+            high = value
+
+    mean[0] = total / n
+    for i in range(n):
+        deviation = data[i] - mean[0]
+        squares += deviation * deviation
+
+    m2[0] = squares
+    lowest[0] = low
+    highest[0] = high
+
+
+def _batch_moments(const _numeric[:] data):
+    cdef double mean = 0, m2 = 0, lowest = 0, highest = 0
+    with nogil:
+        _moments(data, &mean, &m2, &lowest, &highest)
+    return mean, m2, lowest, highest
+
+
+cdef class RunningStats:
+    """
+    An online accumulator for the count, mean, variance, minimum and
+    maximum of a stream of numbers, without keeping the numbers around.
+
+    Single values are added with Welford's update, and batches (any buffer
+    or iterable, as accepted by `average()`) are summarised in a typed loop
+    without the GIL and then combined using Chan et al.'s formula, which is
+    also what `merge()` uses to combine the results from several shards.
+    Accumulators can be pickled, so partial results can be sent back from a
+    process pool.
+
+    Example
+    -------
+    ::
+
+        >>> stats = RunningStats()
+        >>> stats.update([1, 2, 3, 4])
+        >>> stats.add(5)
+        >>> stats.mean, stats.variance
+        (3.0, 2.0)
+    """
+    cdef:
+        readonly long long count
+        double _mean, _m2, _min, _max
+
+    def __init__(self, data=None):
+        self.count = 0
+        self._mean = self._m2 = 0
+        self._min = INFINITY
+        self._max = -INFINITY
+        if data is not None:
+            self.update(data)
+
+    def add(self, double value):
+        """
+        Add a single number.
+        """
+        cdef double delta = value - self._mean
+        self.count += 1
+        self._mean += delta / self.count
+        self._m2 += delta * (value - self._mean)
+        if value < self._min:
+            self._min = value
+        if value > self._max:
+            self._max = value
+
+    def update(self, data):
+        """
+        Add a batch of numbers.
+        """
+        view = _as_numbers(data)
+        if len(view) == 0:
+            return
+        mean, m2, lowest, highest = _batch_moments(view)
+        self._combine(len(view), mean, m2, lowest, highest)
+
+    def merge(self, RunningStats other):
+        """
+        Fold another accumulator's results into this one, returning `self`.
+        """
+        if other.count:
+            self._combine(other.count, other._mean, other._m2, other._min,
+                          other._max)
+        return self
+
+    cdef _combine(self, long long count, double mean, double m2,
+                  double lowest, double highest):
+        cdef:
+            long long total = self.count + count
+            double delta = mean - self._mean
+
+        self._m2 += m2 + delta * delta * self.count * count / total
+        self._mean += delta * count / total
+        self.count = total
+        self._min = min(self._min, lowest)
+        self._max = max(self._max, highest)
+
+    @property
+    def mean(self):
+        return self._mean if self.count else NAN
+
+    @property
+    def variance(self):
+        """
+        The population variance.
+        """
+        return self._m2 / self.count if self.count else NAN
+
+    @property
+    def sample_variance(self):
+        """
+        The sample variance (i.e. divided by `count - 1`).
+        """
+        return self._m2 / (self.count - 1) if self.count > 1 else NAN
+
+    @property
+    def stddev(self):
+        """
+        The population standard deviation.
+        """
+        return sqrt(self.variance)
+
+    @property
+    def min(self):
+        return self._min if self.count else NAN
+
+    @property
+    def max(self):
+        return self._max if self.count else NAN
+
+    def __reduce__(self):
+        return _restore_stats, (self.count, self._mean, self._m2,
+                                self._min, self._max)
+
+    def __repr__(self):
+        return '<{}: count={} mean={} stddev={} min={} max={}>'.format(
+                self.__class__.__name__, self.count, self.mean, self.stddev,
+                self.min, self.max)
+
+
+def _restore_stats(count, mean, m2, lowest, highest):
+    cdef RunningStats stats = RunningStats()
+    stats.count = count
+    stats._mean = mean
+    stats._m2 = m2
+    stats._min = lowest
+    stats._max = highest
+    return stats
+
+
+cdef enum _Statistic:
+    _SUM
+    _MEAN
+    _MIN
+    _MAX
+    _EWMA
+
+_STATISTICS = {'sum': _SUM, 'mean': _MEAN, 'min': _MIN, 'max': _MAX,
+               'ewma': _EWMA}
+
+
+cdef inline void _neumaier_add(double *total, double *compensation,
+                               double value) noexcept nogil:
+    cdef double t = total[0] + value
+    if fabs(total[0]) >= fabs(value):
+        compensation[0] += (total[0] - t) + value
+    else:
+        compensation[0] += (value - t) + total[0]
+    total[0] = t
+
+
+cdef inline void _push_extreme(long long *queue, Py_ssize_t *head,
+                               Py_ssize_t *length, const double *values,
+                               Py_ssize_t width, Py_ssize_t slot,
+                               bint expired, bint lowest) noexcept nogil:
+    """
+    Add the value in `slot` to a monotonic queue (a ring buffer of slots
+    whose values only ever increase, or decrease, from front to back), so
+    the front always holds the window's minimum (or maximum).
+    """
+    cdef:
+        Py_ssize_t back
+        double value = values[slot], other
+
+    # The only slot that can have slid out of the window is the one which
+    # was just overwritten
+    if expired and length[0] and queue[head[0]] == slot:
+        head[0] += 1
+        if head[0] == width:
+            head[0] = 0
+        length[0] -= 1
+
+    # Anything that isn't better than the new value never will be again
+    while length[0]:
+        back = head[0] + length[0] - 1
+        if back >= width:
+            back -= width
+        other = values[queue[back]]
+        if (other < value) if lowest else (other > value):
+            break
+        length[0] -= 1
+
+    back = head[0] + length[0]
+    if back >= width:
+        back -= width
+    queue[back] = slot
+    length[0] += 1
+
+
+cdef class RollingWindow:
+    """
+    The sum, mean, minimum, maximum and exponentially weighted mean of the
+    last `window` numbers in a stream.
+
+    Every statistic is updated in amortised O(1) time per number, no matter
+    how wide the window is. The window is a ring buffer with a compensated
+    running sum, so adding and removing numbers for a long time doesn't
+    make the sum drift, and the minimum and maximum come from monotonic
+    queues of positions in the window. The exponentially weighted mean
+    isn't limited to the window; it weights every number seen so far.
+
+    Use `rolling()` to get a statistic for every window of a whole buffer.
+
+    Parameters
+    ----------
+    window: int
+        How many of the most recent numbers to keep.
+    alpha: float or None
+        The smoothing factor for the exponentially weighted mean, between 0
+        (exclusive) and 1. If None, `2 / (window + 1)` is used, which gives
+        the numbers roughly the same average age as a plain moving average
+        over the window. (default: None)
+
+    Example
+    -------
+    ::
+
+        >>> window = RollingWindow(3)
+        >>> window.update([4, 1, 3, 2])
+        >>> window.mean, window.min, window.max
+        (2.0, 1.0, 3.0)
+    """
+    cdef:
+        readonly Py_ssize_t window
+        readonly double alpha
+        readonly long long seen
+        double[::1] _values
+        long long[::1] _lows, _highs
+        Py_ssize_t _slot, _low_head, _low_len, _high_head, _high_len
+        double _sum, _compensation, _ewma
+
+    def __init__(self, window, alpha=None):
+        if not isinstance(window, int):
+            raise TypeError('The window must be an integer')
+        if window < 1:
+            raise ValueError('The window must be at least 1')
+        if alpha is None:
+            alpha = 2 / (window + 1)
+        if not 0 < alpha <= 1:
+            raise ValueError('alpha must be in the range (0, 1]')
+
+        self.window = window
+        self.alpha = alpha
+        self._values = array('d', [0]) * window
+        self._lows = array('q', [0]) * window
+        self._highs = array('q', [0]) * window
+        self.clear()
+
+    def clear(self):
+        """
+        Forget every number seen so far.
+        """
+        self.seen = self._slot = 0
+        self._low_head = self._low_len = self._high_head = self._high_len = 0
+        self._sum = self._compensation = self._ewma = 0
+
+    def add(self, double value):
+        """
+        Add a single number, pushing the oldest one out of a full window.
+        """
+        self._push(value)
+
+    def update(self, data):
+        """
+        Add a batch of numbers (any buffer or iterable, as accepted by
+        `average()`).
+        """
+        view = _as_numbers(data)
+        if len(view):
+            _rolling(view, self, _MEAN, None)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _push(self, double value) noexcept nogil:
+        cdef:
+            Py_ssize_t slot = self._slot
+            bint full = self.seen >= self.window
+
+        if full:
+            _neumaier_add(&self._sum, &self._compensation, -self._values[slot])
+        self._values[slot] = value
+        _neumaier_add(&self._sum, &self._compensation, value)
+
+        if self.seen:
+            self._ewma += self.alpha * (value - self._ewma)
+        else:
+            self._ewma = value
+
+        _push_extreme(&self._lows[0], &self._low_head, &self._low_len,
+                      &self._values[0], self.window, slot, full, True)
+        _push_extreme(&self._highs[0], &self._high_head, &self._high_len,
+                      &self._values[0], self.window, slot, full, False)
+
+        self.seen += 1
+        self._slot = slot + 1 if slot + 1 < self.window else 0
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef double _statistic(self, _Statistic statistic) noexcept nogil:
+        cdef Py_ssize_t count = min(self.seen, self.window)
+
+        if statistic == _SUM:
+            return self._sum + self._compensation
+        if count == 0:
+            return NAN
+        if statistic == _MEAN:
+            return (self._sum + self._compensation) / count
+        if statistic == _MIN:
+            return self._values[self._lows[self._low_head]]
+        if statistic == _MAX:
+            return self._values[self._highs[self._high_head]]
+        return self._ewma
+
+    @property
+    def count(self):
+        """
+        How many numbers are in the window (at most `window`).
+        """
+        return min(self.seen, self.window)
+
+    @property
+    def sum(self):
+        return self._statistic(_SUM)
+
+    @property
+    def mean(self):
+        return self._statistic(_MEAN)
+
+    @property
+    def min(self):
+        return self._statistic(_MIN)
+
+    @property
+    def max(self):
+        return self._statistic(_MAX)
+
+    @property
+    def ewma(self):
+        """
+        The exponentially weighted mean of every number seen so far.
+        """
+        return self._statistic(_EWMA)
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return '<{}: window={} count={} mean={} min={} max={}>'.format(
+                self.__class__.__name__, self.window, self.count, self.mean,
+                self.min, self.max)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _rolling(const _numeric[:] data, RollingWindow window,
+             _Statistic statistic, double[::1] out):
+    cdef:
+        Py_ssize_t i, j = 0, first = window.window - 1
+        bint collect = out is not None
+
+    with nogil:
+        if not collect:
+            for i in range(data.shape[0]):
+                window._push(data[i])
+        else:
+            for i in range(data.shape[0]):
+                window._push(data[i])
+                if i >= first:
+                    out[j] = window._statistic(statistic)
+                    j += 1
+
+
+def rolling(data, window, statistic='mean', alpha=None):
+    """
+    Calculate a statistic over every window of `window` consecutive numbers.
+
+    This is the same as (but much quicker than) calling `average()` on each
+    slice ``data[i:i + window]``, and takes O(n) time rather than
+    O(n * window). Only full windows are reported, so the result is
+    ``window - 1`` numbers shorter than `data` (or empty, if `data` is
+    shorter than a window).
+
+    Parameters
+    ----------
+    data: buffer or iterable of numbers
+        The numbers, as accepted by `average()`.
+    window: int
+        How many numbers are in each window.
+    statistic: str
+        One of 'mean', 'sum', 'min', 'max' or 'ewma' (the exponentially
+        weighted mean of every number up to the end of each window, see
+        `RollingWindow`). (default: 'mean')
+    alpha: float or None
+        The smoothing factor for 'ewma'. (default: None)
+
+    Returns
+    -------
+    array('d')
+        The statistic for each window.
+    """
+    if statistic not in _STATISTICS:
+        raise ValueError('Unknown statistic: {!r}'.format(statistic))
+
+    state = RollingWindow(window, alpha)
+    view = _as_numbers(data)
+    out = array('d', [0]) * max(len(view) - window + 1, 0)
+    if len(view):
+        _rolling(view, state, _STATISTICS[statistic], out)
+    return out
+
+
+cdef int _compare_means(const void *a, const void *b) noexcept nogil:
+    cdef double x = (<const double *>a)[0], y = (<const double *>b)[0]
+    return (x > y) - (x < y)
+
+
+cdef inline double _next_limit(double q, double compression) noexcept nogil:
+    """
+    The quantile one unit further along the t-digest's k1 scale,
+    ``k(q) = compression / (2 pi) * asin(2q - 1)``, than `q`.
+    """
+    cdef double angle = asin(2 * q - 1) + 2 * M_PI / compression
+    return (sin(min(angle, M_PI / 2)) + 1) / 2
+
+
+cdef inline double _lerp(double a, double b, double t) noexcept nogil:
+    """
+    Interpolate from `a` (t = 0) to `b` (t = 1), without multiplying an
+    infinite end by zero.
+    """
+    if t <= 0 or a == b:
+        return a
+    if t >= 1:
+        return b
+    return a * (1 - t) + b * t
+
+
+# How many numbers a TDigest buffers (as a multiple of its compression)
+# before they are merged into the centroids
+cdef enum:
+    _DIGEST_BUFFER = 8
+
+_DIGEST_HEADER = struct.Struct('<4sBdqdd')
+_DIGEST_MAGIC = b'TDG\x00'
+
+
+cdef class TDigest:
+    """
+    A sketch of a stream of numbers which can estimate any quantile (e.g.
+    the median or the 99.9th percentile) in a small, fixed amount of memory.
+
+    This is Dunning's merging t-digest. Numbers are collected in a buffer
+    and, when it fills up, sorted and merged into a list of centroids (a
+    mean and a weight) using the k1 scale function. That lets centroids
+    near the median cover a lot of numbers while those at the extremes
+    cover very few, so the estimate of a quantile `q` is most accurate
+    when `q` is close to 0 or 1.
+
+    Accuracy
+    --------
+    A t-digest doesn't give a hard worst-case bound. The error in the
+    *rank* of an estimate (the fraction of numbers below it, compared to
+    `q`) shrinks roughly in proportion to `compression` and to
+    ``sqrt(q * (1 - q))``. With the default compression of 100, on a
+    million numbers from normal, uniform, exponential and Pareto
+    distributions, the rank error was at most about 0.1% for any quantile
+    and about 0.05% from p99 outwards. The minimum and maximum are always
+    exact, small streams (up to about `compression / 2` numbers) are kept
+    exactly, and merging digests adds only a little extra error. For
+    p99.9 and beyond on heavy-tailed data a compression of a few hundred
+    is a better choice (500 cut the rank error at p99.9 of ten million
+    log-normal numbers from 0.04% to 0.001%).
+
+    Memory
+    ------
+    At most ``(2 + _DIGEST_BUFFER) * compression`` means and weights (so
+    about 16 KB with the default compression) however many numbers are
+    added. Only about `compression / 2` centroids are kept once the buffer
+    has been merged, which is all that `to_bytes()` saves.
+
+    Parameters
+    ----------
+    compression: float
+        The trade-off between size and accuracy. Doubling it roughly halves
+        the error and doubles the memory used. (default: 100)
+
+    Example
+    -------
+    ::
+
+        >>> digest = TDigest()
+        >>> digest.update(range(1, 10001))
+        >>> digest.quantile(0.5)
+        5000.5
+    """
+    cdef:
+        readonly double compression
+        double[::1] _data
+        Py_ssize_t _n, _merged, _capacity
+        double _total, _min, _max
+
+    def __init__(self, compression=100):
+        if not isinstance(compression, (int, float)):
+            raise TypeError('The compression must be a number')
+        if not 10 <= compression <= 10**6:
+            raise ValueError('The compression must be between 10 and 1e6')
+
+        self.compression = compression
+        self._capacity = <Py_ssize_t>((2 + _DIGEST_BUFFER) * self.compression) + 2
+        # Interleaved (mean, weight) pairs, centroids first and then the
+        # buffered numbers
+        self._data = array('d', [0]) * (2 * self._capacity)
+        self._n = self._merged = 0
+        self._total = 0
+        self._min = INFINITY
+        self._max = -INFINITY
+
+    def add(self, double value):
+        """
+        Add a single number (NaN is ignored).
+        """
+        if value == value:
+            self._push(value, 1, value, value)
+
+    def update(self, data):
+        """
+        Add a batch of numbers (any buffer or iterable, as accepted by
+        `average()`). NaNs are ignored.
+        """
+        view = _as_numbers(data)
+        if len(view):
+            _digest_update(view, self)
+
+    def merge(self, TDigest other):
+        """
+        Fold another digest into this one, returning `self`.
+        """
+        cdef:
+            Py_ssize_t i, n = other._n
+            double lowest = other._min, highest = other._max
+            # A copy, since pushing can compress `other` when it is `self`
+            double[::1] theirs = array('d', other._data[:2 * n])
+
+        for i in range(n):
+            self._push(theirs[2 * i], theirs[2 * i + 1], lowest, highest)
+        return self
+
+    cdef void _push(self, double mean, double weight, double lowest,
+                    double highest) noexcept nogil:
+        if self._n == self._capacity:
+            self._compress()
+
+        self._data[2 * self._n] = mean
+        self._data[2 * self._n + 1] = weight
+        self._n += 1
+        self._total += weight
+        if lowest < self._min:
+            self._min = lowest
+        if highest > self._max:
+            self._max = highest
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef void _compress(self) noexcept nogil:
+        """
+        Sort everything and merge neighbours for as long as each centroid
+        spans less than one unit of the k1 scale.
+        """
+        cdef:
+            double *data = &self._data[0]
+            Py_ssize_t i, kept = 0
+            double so_far = 0, limit, weight
+
+        if self._merged == self._n:
+            return
+
+        qsort(data, self._n, 2 * sizeof(double), _compare_means)
+        limit = self._total * _next_limit(0, self.compression)
+
+        for i in range(1, self._n):
+            weight = data[2 * i + 1]
+            if so_far + data[2 * kept + 1] + weight <= limit:
+                data[2 * kept + 1] += weight
+                # Equal means are skipped so infinities don't give inf - inf
+                if data[2 * i] != data[2 * kept]:
+                    data[2 * kept] += ((data[2 * i] - data[2 * kept]) *
+                                       weight / data[2 * kept + 1])
+            else:
+                so_far += data[2 * kept + 1]
+                limit = self._total * _next_limit(so_far / self._total,
+                                                  self.compression)
+                kept += 1
+                data[2 * kept] = data[2 * i]
+                data[2 * kept + 1] = weight
+
+        self._n = self._merged = kept + 1
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef double _quantile(self, double q) noexcept nogil:
+        cdef:
+            double *data = &self._data[0]
+            Py_ssize_t i, n = self._n
+            double index = q * self._total, so_far, step, first, last
+
+        if n == 0:
+            return NAN
+        self._compress()
+        n = self._n
+
+        # Interpolate between the extremes and the centres of the outermost
+        # centroids, which hold half of their weight on either side
+        if index < 1:
+            return self._min
+        first = data[1]
+        if first > 1 and index < first / 2:
+            return _lerp(self._min, data[0], (index - 1) / (first / 2 - 1))
+        if index > self._total - 1:
+            return self._max
+        last = data[2 * n - 1]
+        if last > 1 and self._total - index <= last / 2:
+            return _lerp(self._max, data[2 * n - 2],
+                         (self._total - index - 1) / (last / 2 - 1))
+
+        so_far = first / 2
+        for i in range(n - 1):
+            step = (data[2 * i + 1] + data[2 * i + 3]) / 2
+            if so_far + step > index:
+                return _lerp(data[2 * i], data[2 * i + 2],
+                             (index - so_far) / step)
+            so_far += step
+        return data[2 * n - 2]
+
+    def quantile(self, double q):
+        """
+        Estimate the number which a fraction `q` of the numbers seen so far
+        are below, or NaN if the digest is empty.
+        """
+        if not 0 <= q <= 1:
+            raise ValueError('The quantile must be between 0 and 1')
+        return self._quantile(q)
+
+    def quantiles(self, qs):
+        """
+        Estimate several quantiles at once, as a list.
+        """
+        return [self.quantile(q) for q in qs]
+
+    @property
+    def count(self):
+        """
+        How many numbers have been added.
+        """
+        return <long long>self._total
+
+    @property
+    def min(self):
+        return self._min if self._n else NAN
+
+    @property
+    def max(self):
+        return self._max if self._n else NAN
+
+    @property
+    def centroids(self):
+        """
+        The (mean, weight) of each centroid, in order.
+        """
+        self._compress()
+        pairs = self._data[:2 * self._n]
+        return list(zip(pairs[::2], pairs[1::2]))
+
+    def __len__(self):
+        """
+        How many centroids the digest is using.
+        """
+        self._compress()
+        return self._n
+
+    def to_bytes(self):
+        """
+        Serialise the digest into a compact, portable form which can be
+        turned back into a digest with `TDigest.from_bytes()`.
+        """
+        self._compress()
+        centroids = array('d', self._data[:2 * self._n])
+        if sys.byteorder != 'little':
+            centroids.byteswap()
+        return _DIGEST_HEADER.pack(_DIGEST_MAGIC, 1, self.compression,
+                                   self._n, self._min,
+                                   self._max) + centroids.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Load a digest saved with `to_bytes()`.
+        """
+        cdef TDigest digest
+        cdef Py_ssize_t i
+
+        try:
+            magic, version, compression, n, lowest, highest = \
+                _DIGEST_HEADER.unpack_from(data)
+        except struct.error:
+            raise ValueError('Not a serialised TDigest')
+        if magic != _DIGEST_MAGIC or version != 1:
+            raise ValueError('Not a serialised TDigest')
+
+        centroids = array('d')
+        centroids.frombytes(data[_DIGEST_HEADER.size:])
+        if len(centroids) != 2 * n:
+            raise ValueError('The serialised TDigest is truncated')
+        if sys.byteorder != 'little':
+            centroids.byteswap()
+
+        digest = cls(compression)
+        for i in range(n):
+            digest._push(centroids[2 * i], centroids[2 * i + 1], lowest,
+                         highest)
+        return digest
+
+    def __reduce__(self):
+        return TDigest.from_bytes, (self.to_bytes(),)
+
+    def __repr__(self):
+        return '<{}: compression={} count={} centroids={}>'.format(
+                self.__class__.__name__, self.compression, self.count,
+                len(self))
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _digest_update(const _numeric[:] data, TDigest digest):
+    cdef:
+        Py_ssize_t i
+        double value
+
+    with nogil:
+        for i in range(data.shape[0]):
+            value = data[i]
+            if value == value:
+                digest._push(value, 1, value, value)
+
+
+# Limits are kept below this so that `p * p` and "next multiple of p" never
+# overflow a 64-bit integer.
+_MAX_LIMIT = 2**62
+
+
+cdef _packed_sieve(long long n):
     """
+    A sieve of Erosthenes over the odd numbers only, using one bit per
+    candidate (bit `i` stands for `2*i + 1`, and is set once that number is
+    known to be composite). Returns all primes up to and including `n` as an
+    `array('l')`.
 
+    Note that all type and value checking is done by a python wrapper.
+    """
     cdef:
-        list primes = []
-        int i, number
-        list sieve = [True for i in range(n + 1)]
+        long long m = (n - 1) // 2, i, j, p, count, k
+        unsigned char[::1] composite
+        long[::1] out
+
+    bits = bytearray(m // 8 + 1)
+    composite = bits
+
+    # 1 isn't prime
+    composite[0] = 1
+
+    i = 1
+    while True:
+        p = 2 * i + 1
+        if p * p > n:
+            break
+        if not composite[i >> 3] & (1 << (i & 7)):
+            # Odd multiples of p, starting at p * p, are p apart in the bits
+            j = (p * p) // 2
+            while j <= m:
+                composite[j >> 3] |= 1 << (j & 7)
+                j += p
+        i += 1
 
-    for number in range(2, n + 1):
-        if sieve[number]:
-           primes.append(number)
-           for i in range(number * number, n + 1, number):
-               sieve[i] = False
+    count = 1 if n >= 2 else 0
+    for i in range(1, m + 1):
+        if not composite[i >> 3] & (1 << (i & 7)):
+            count += 1
+
+    primes = array('l', [0]) * count
+    if count == 0:
+        return primes
+
+    out = primes
+    out[0] = 2
+    k = 1
+    for i in range(1, m + 1):
+        if not composite[i >> 3] & (1 << (i & 7)):
+            out[k] = 2 * i + 1
+            k += 1
     return primes
 
 
+cdef _sieve_of_erosthenes(long long n):
+    """
+    All primes up to and including `n` as a list.
+
+    Note that all type and value checking is done by a python wrapper.
+    """
+    return _packed_sieve(n).tolist()
+
+
+def packed_sieve(n):
+    """
+    Like `sieve_of_erosthenes()`, but returns the primes as an `array('l')`
+    instead of a list.
+
+    Only odd numbers are sieved, at one bit each, so sieving up to `n`
+    takes `n / 16` bytes (compared to 8 bytes per number for a list of
+    bools), and the result takes 8 bytes per prime instead of a pointer
+    plus an int object.
+    """
+    if not isinstance(n, int):
+        raise TypeError('n must be a positive integer')
+    if n <= 0:
+        raise ValueError('n must be a positive integer')
+    if n > _MAX_LIMIT:
+        raise ValueError('n must be at most 2**62')
+
+    return _packed_sieve(n)
+
+
 def sieve_of_erosthenes(n):
     """
     A thin python wrapper function around _sieve_of_erosthenes() to do all 
@@ -41,3 +1026,770 @@ def sieve_of_erosthenes(n):
 
     return _sieve_of_erosthenes(n)
 
+
+cdef _small_primes(long long limit):
+    """
+    All the primes up to and including `limit` as an `array('q')`. This is
+    only used to get the sieving primes for a segmented sieve, so `limit` is
+    around the square root of the range.
+    """
+    if limit < 2:
+        return array('q')
+    return array('q', _packed_sieve(limit))
+
+
+def _primes_between(long long lo, long long hi, long long segment_size):
+    cdef:
+        long long start, end, p, j
+        Py_ssize_t k, i, count
+        long long[::1] primes, multiples
+        unsigned char[::1] segment
+
+    base = _small_primes(isqrt(hi - 1)) if hi > 2 else array('q')
+    count = len(base)
+    primes = base
+    multiples = array('q', base)
+    segment = bytearray(segment_size)
+
+    # Start each prime off at its first multiple in the window which isn't
+    # the prime itself (anything below p * p has a smaller factor anyway)
+    lo = max(lo, 2)
+    for k in range(count):
+        p = primes[k]
+        multiples[k] = max(p * p, (lo + p - 1) // p * p)
+
+    start = lo
+    while start < hi:
+        end = min(start + segment_size, hi)
+        memset(&segment[0], 1, end - start)
+
+        for k in range(count):
+            p = primes[k]
+            if p * p >= end:
+                break
+            j = multiples[k]
+            while j < end:
+                segment[j - start] = 0
+                j += p
+            multiples[k] = j
+
+        for i in range(end - start):
+            if segment[i]:
+                yield start + i
+
+        start = end
+
+
+def primes_between(lo, hi, segment_size=32768):
+    """
+    Generate the primes `p` with `lo <= p < hi`, in order.
+
+    This is a segmented sieve of Erosthenes: the window is sieved one
+    `segment_size` byte block at a time (small enough to stay in the CPU
+    cache) using the primes up to `sqrt(hi)`, so memory use is
+    `O(segment_size + sqrt(hi))` no matter how wide the window is. That
+    makes windows like `[10**12, 10**12 + 10**8)` cheap to enumerate.
+    """
+    for name, value in [('lo', lo), ('hi', hi), ('segment_size', segment_size)]:
+        if not isinstance(value, int):
+            raise TypeError('{} must be an integer'.format(name))
+    if lo < 0 or hi < 0:
+        raise ValueError('lo and hi must not be negative')
+    if hi > _MAX_LIMIT:
+        raise ValueError('hi must be at most 2**62')
+    if segment_size <= 0:
+        raise ValueError('segment_size must be a positive integer')
+
+    return _primes_between(lo, hi, segment_size)
+
+
+def segmented_sieve(n, segment_size=32768):
+    """
+    A lazy version of `sieve_of_erosthenes()`, generating the primes up to
+    and including `n` with bounded memory (see `primes_between()`).
+    """
+    if not isinstance(n, int):
+        raise TypeError('n must be a positive integer')
+    if n <= 0:
+        raise ValueError('n must be a positive integer')
+
+    return primes_between(2, n + 1, segment_size)
+
+
+# How many odd numbers a worker sieves at a time, so its slice of the
+# sieve stays in cache
+cdef Py_ssize_t _BLOCK = 32768
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef _sieve_odd_range(long long lo, long long hi, const long[::1] primes):
+    """
+    Find the primes in `[lo, hi)` (where `lo` is odd) using the odd sieving
+    primes in `primes`, returning them as an `array('l')`. Everything but
+    allocating the buffers happens without the GIL, so several threads can
+    run this at once.
+    """
+    cdef:
+        Py_ssize_t size = (hi - lo + 1) // 2, count = 0, k, nprimes
+        Py_ssize_t block, block_end, i, index
+        long long p, first
+        unsigned char[::1] composite
+        long long[::1] next_index
+        long[::1] out
+
+    nprimes = primes.shape[0]
+    composite = bytearray(size)
+    next_index = array('q', [0]) * nprimes
+
+    with nogil:
+        # The index of each prime's first odd multiple in the range
+        for k in range(nprimes):
+            p = primes[k]
+            first = max(p * p, (lo + p - 1) // p * p)
+            if first % 2 == 0:
+                first += p
+            next_index[k] = (first - lo) // 2
+
+        if lo == 1 and size > 0:
+            composite[0] = 1
+
+        # Odd multiples of p are p apart in index space
+        block = 0
+        while block < size:
+            block_end = min(block + _BLOCK, size)
+            for k in range(nprimes):
+                index = next_index[k]
+                p = primes[k]
+                while index < block_end:
+                    composite[index] = 1
+                    index += p
+                next_index[k] = index
+            block = block_end
+
+        for i in range(size):
+            if not composite[i]:
+                count += 1
+
+    primes_found = array('l', [0]) * count
+    if count:
+        out = primes_found
+        with nogil:
+            k = 0
+            for i in range(size):
+                if not composite[i]:
+                    out[k] = lo + 2 * i
+                    k += 1
+    return primes_found
+
+
+def parallel_sieve(n, workers=None):
+    """
+    The same as `sieve_of_erosthenes()`, but with the sieving spread across
+    a pool of `workers` threads (by default one per CPU).
+
+    The range is cut into chunks which are sieved without the GIL, so
+    threads really do run in parallel. Turning the result into a list is
+    still done on one core.
+    """
+    if not isinstance(n, int):
+        raise TypeError('n must be a positive integer')
+    if n <= 0:
+        raise ValueError('n must be a positive integer')
+    if n > _MAX_LIMIT:
+        raise ValueError('n must be at most 2**62')
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if not isinstance(workers, int) or workers <= 0:
+        raise ValueError('workers must be a positive integer')
+
+    if n < 2:
+        return []
+
+    # The odd sieving primes
+    base = _packed_sieve(isqrt(n))[1:]
+
+    # A few chunks per worker evens out the load, since chunks further up
+    # the range have fewer multiples to cross off
+    chunk = max((n // (4 * workers)) | 1, 2 * _BLOCK + 1)
+    if chunk % 2:
+        chunk += 1
+    bounds = [(lo, min(lo + chunk, n + 1)) for lo in range(1, n + 1, chunk)]
+
+    primes = [2]
+    if workers == 1:
+        for lo, hi in bounds:
+            primes.extend(_sieve_odd_range(lo, hi, base))
+    else:
+        with ThreadPoolExecutor(workers) as pool:
+            for found in pool.map(lambda bound: _sieve_odd_range(
+                    bound[0], bound[1], base), bounds):
+                primes.extend(found)
+    return primes
+
+
+# The number of set bits in each possible byte
+cdef unsigned char _POPCOUNT[256]
+for _byte in range(256):
+    _POPCOUNT[_byte] = bin(_byte).count('1')
+
+
+# PrimeTable grows in blocks of this many bytes (i.e. 1024 numbers), and
+# keeps a running count of primes for each block
+cdef Py_ssize_t _TABLE_BLOCK = 64
+
+
+cdef class PrimeTable:
+    """
+    A cache of which numbers are prime, extended incrementally as bigger
+    numbers are asked about.
+
+    The table is an odd-only bitmap (as in `packed_sieve()`) plus a running
+    count of primes every 1024 numbers. Asking about a number past the end
+    of the table sieves only the new range, at least doubling the table so
+    that a slowly growing limit costs amortised O(1) extensions. After that
+    `is_prime()` is a single bit lookup, and `nth_prime()` is a binary
+    search over the counts followed by a scan of at most one block.
+
+    One `PrimeTable` is shared by the module-level `is_prime()`,
+    `nth_prime()` and `primes_upto()` (see `prime_table`).
+
+    Parameters
+    ----------
+    max_bytes: int or None
+        The most memory the bitmap may use, or None for no limit. Beyond
+        `16 * max_bytes`, `is_prime()` falls back to a Miller-Rabin test
+        (see `is_prime_many()`) and `nth_prime()` and `primes_upto()` use a
+        segmented sieve each time instead of caching anything.
+        (default: None)
+    """
+    cdef bytearray _bits
+    cdef object _counts
+    cdef readonly object max_bytes
+
+    def __init__(self, max_bytes=None):
+        if max_bytes is not None and (not isinstance(max_bytes, int) or
+                                      max_bytes < 0):
+            raise ValueError('max_bytes must be None or a non-negative integer')
+        self.max_bytes = max_bytes
+        self.clear()
+
+    def clear(self):
+        """
+        Throw the whole table away.
+        """
+        self._bits = bytearray()
+        self._counts = array('q', [0])
+
+    @property
+    def limit(self):
+        """
+        Every number below this is in the table.
+        """
+        return 16 * len(self._bits)
+
+    @property
+    def nbytes(self):
+        """
+        How much memory the table is using.
+        """
+        return len(self._bits) + self._counts.itemsize * len(self._counts)
+
+    def extend(self, n):
+        """
+        Make sure the table covers everything up to and including `n`,
+        returning False if that would go over `max_bytes`.
+        """
+        cdef Py_ssize_t old_size = len(self._bits), size
+
+        if n < self.limit:
+            return True
+
+        # Grow geometrically, in whole blocks
+        size = max(n // 16 + 1, 2 * old_size)
+        size = (size + _TABLE_BLOCK - 1) // _TABLE_BLOCK * _TABLE_BLOCK
+        if self.max_bytes is not None and size > self.max_bytes:
+            size = self.max_bytes // _TABLE_BLOCK * _TABLE_BLOCK
+            if 16 * size <= n:
+                if size > old_size:
+                    self._sieve(old_size, size)
+                return False
+
+        self._sieve(old_size, size)
+        return True
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _sieve(self, Py_ssize_t old_size, Py_ssize_t size):
+        """
+        Grow the bitmap from `old_size` to `size` bytes, sieving the numbers
+        it now covers and counting the primes in each new block.
+        """
+        cdef:
+            unsigned char[::1] bits
+            const long[::1] primes
+            long long lo = 16 * old_size, hi = 16 * size, p, first
+            Py_ssize_t k, index, end = 8 * size, block, i, total, old_blocks
+            long long[::1] counts
+
+        self._bits.extend(bytes(size - old_size))
+        bits = self._bits
+        primes = _packed_sieve(isqrt(hi))[1:]
+
+        if old_size == 0:
+            # 1 isn't prime
+            bits[0] = 1
+
+        for k in range(primes.shape[0]):
+            p = primes[k]
+            first = max(p * p, (lo + p - 1) // p * p)
+            if first % 2 == 0:
+                first += p
+            index = first // 2
+            while index < end:
+                bits[index >> 3] |= 1 << (index & 7)
+                index += p
+
+        old_blocks = len(self._counts) - 1
+        self._counts.extend(array('q', [0]) * (size // _TABLE_BLOCK -
+                                                 old_blocks))
+        counts = self._counts
+        total = counts[old_blocks]
+        for block in range(old_blocks, size // _TABLE_BLOCK):
+            for i in range(block * _TABLE_BLOCK, (block + 1) * _TABLE_BLOCK):
+                total += 8 - _POPCOUNT[bits[i]]
+            counts[block + 1] = total
+
+    def is_prime(self, k):
+        """
+        Check whether `k` is prime.
+        """
+        if not isinstance(k, int):
+            raise TypeError('k must be an integer')
+        if k < 3 or k % 2 == 0:
+            return k == 2
+        if k > _MAX_LIMIT:
+            raise ValueError('k must be at most 2**62')
+
+        # Numbers past what the table may cover get a Miller-Rabin test,
+        # rather than growing the table up to its cap or re-sieving
+        if self.max_bytes is not None and k >= 16 * self.max_bytes:
+            return _is_prime_u64(k)
+        if not self.extend(k):
+            return _is_prime_u64(k)
+
+        cdef long long index = k // 2
+        return not self._bits[index >> 3] & (1 << (index & 7))
+
+    def nth_prime(self, i):
+        """
+        Get the `i`-th prime, counting from `nth_prime(1) == 2`.
+        """
+        cdef:
+            long long[::1] counts
+            Py_ssize_t block, byte, bit, lo, hi, mid
+            long long remaining
+            unsigned char value
+
+        if not isinstance(i, int):
+            raise TypeError('i must be a positive integer')
+        if i <= 0:
+            raise ValueError('i must be a positive integer')
+        if i == 1:
+            return 2
+
+        # p_i < i * (ln(i) + ln(ln(i))) for i >= 6
+        if i < 6:
+            bound = 13
+        else:
+            bound = int(i * (_log(i) + _log(_log(i)))) + 1
+
+        # Only odd primes are in the table
+        remaining = i - 1
+        if not self.extend(bound) and remaining > self._counts[-1]:
+            remaining -= self._counts[-1]
+            for p in _primes_between(self.limit, bound + 1, 32768):
+                remaining -= 1
+                if remaining == 0:
+                    return p
+
+        # Find the first block with enough primes before its end...
+        counts = self._counts
+        lo, hi = 0, counts.shape[0] - 2
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if counts[mid + 1] < remaining:
+                lo = mid + 1
+            else:
+                hi = mid
+        block = lo
+        remaining -= counts[block]
+
+        # ...then walk through it
+        byte = block * _TABLE_BLOCK
+        while True:
+            value = self._bits[byte]
+            if 8 - _POPCOUNT[value] >= remaining:
+                break
+            remaining -= 8 - _POPCOUNT[value]
+            byte += 1
+        for bit in range(8):
+            if not value & (1 << bit):
+                remaining -= 1
+                if remaining == 0:
+                    return 2 * (8 * byte + bit) + 1
+
+    def primes_upto(self, n):
+        """
+        All primes up to and including `n` as an `array('l')`, the same as
+        `packed_sieve(n)`.
+        """
+        cdef:
+            const unsigned char[::1] bits
+            long[::1] out
+            long long m, i, k, count
+
+        if not isinstance(n, int):
+            raise TypeError('n must be an integer')
+        if n > _MAX_LIMIT:
+            raise ValueError('n must be at most 2**62')
+        if n < 2:
+            return array('l')
+        if not self.extend(n):
+            return _packed_sieve(n)
+
+        bits = self._bits
+        m = (n - 1) // 2
+        count = 1
+        for i in range(1, m + 1):
+            if not bits[i >> 3] & (1 << (i & 7)):
+                count += 1
+
+        primes = array('l', [0]) * count
+        out = primes
+        out[0] = 2
+        k = 1
+        for i in range(1, m + 1):
+            if not bits[i >> 3] & (1 << (i & 7)):
+                out[k] = 2 * i + 1
+                k += 1
+        return primes
+
+    def __repr__(self):
+        return '<{}: limit={} nbytes={} max_bytes={}>'.format(
+                self.__class__.__name__, self.limit, self.nbytes,
+                self.max_bytes)
+
+
+prime_table = PrimeTable(max_bytes=16 * 1024 * 1024)
+"""
+The process-wide table behind `is_prime()`, `nth_prime()` and
+`primes_upto()`. It is capped at 16 MB, which caches every number below
+about 2.7e8.
+"""
+
+
+def is_prime(k):
+    """
+    Check whether `k` is prime, using (and if necessary extending) the
+    shared `prime_table`.
+    """
+    return prime_table.is_prime(k)
+
+
+def nth_prime(i):
+    """
+    Get the `i`-th prime (`nth_prime(1) == 2`) from the shared
+    `prime_table`.
+    """
+    return prime_table.nth_prime(i)
+
+
+def primes_upto(n):
+    """
+    Get all primes up to and including `n` as an `array('l')` from the
+    shared `prime_table`.
+    """
+    return prime_table.primes_upto(n)
+
+
+cdef extern from *:
+    """
+    /* (a * b) % m without overflowing, for any 64-bit a, b and m */
+    #if defined(__SIZEOF_INT128__)
+    static inline unsigned long long utils_mulmod(unsigned long long a,
+                                                  unsigned long long b,
+                                                  unsigned long long m) {
+        return (unsigned long long)((unsigned __int128)a * b % m);
+    }
+    #else
+    static inline unsigned long long utils_mulmod(unsigned long long a,
+                                                  unsigned long long b,
+                                                  unsigned long long m) {
+        unsigned long long result = 0;
+        a %= m;
+        while (b) {
+            if (b & 1)
+                result = result >= m - a ? result - (m - a) : result + a;
+            a = a >= m - a ? a - (m - a) : a + a;
+            b >>= 1;
+        }
+        return result;
+    }
+    #endif
+    """
+    unsigned long long _mulmod "utils_mulmod" (
+        unsigned long long a, unsigned long long b,
+        unsigned long long m) nogil
+
+
+# Candidates are trial divided by the primes below this before falling back
+# to Miller-Rabin, so anything below its square which survives is prime
+cdef enum:
+    _TRIAL_LIMIT = 256
+
+cdef unsigned long long _TRIAL_PRIMES[_TRIAL_LIMIT]
+cdef Py_ssize_t _TRIAL_COUNT = 0
+for _prime in _packed_sieve(_TRIAL_LIMIT - 1):
+    _TRIAL_PRIMES[_TRIAL_COUNT] = _prime
+    _TRIAL_COUNT += 1
+
+# These bases give a deterministic Miller-Rabin test for every n < 2**64
+cdef unsigned long long _MR_BASES[7]
+_MR_BASES[:] = [2, 325, 9375, 28178, 450775, 9780504, 1795265022]
+
+
+cdef inline unsigned long long _powmod(unsigned long long base,
+                                       unsigned long long exponent,
+                                       unsigned long long m) noexcept nogil:
+    cdef unsigned long long result = 1
+    base %= m
+    while exponent:
+        if exponent & 1:
+            result = _mulmod(result, base, m)
+        base = _mulmod(base, base, m)
+        exponent >>= 1
+    return result
+
+
+cdef bint _is_prime_u64(unsigned long long n) noexcept nogil:
+    cdef:
+        Py_ssize_t k
+        unsigned long long p, d, x, a
+        int r, s
+
+    if n < 2:
+        return False
+    for k in range(_TRIAL_COUNT):
+        p = _TRIAL_PRIMES[k]
+        if n % p == 0:
+            return n == p
+    if n < <unsigned long long>_TRIAL_LIMIT * _TRIAL_LIMIT:
+        return True
+
+    # n - 1 == d * 2**s with d odd
+    d = n - 1
+    s = 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    for k in range(7):
+        a = _MR_BASES[k] % n
+        if a == 0:
+            continue
+        x = _powmod(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for r in range(1, s):
+            x = _mulmod(x, x, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef _check_signed(const long long[:] values, unsigned char[::1] out):
+    cdef Py_ssize_t i
+    with nogil:
+        for i in range(values.shape[0]):
+            out[i] = values[i] > 1 and _is_prime_u64(values[i])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef _check_unsigned(const unsigned long long[:] values,
+                     unsigned char[::1] out):
+    cdef Py_ssize_t i
+    with nogil:
+        for i in range(values.shape[0]):
+            out[i] = _is_prime_u64(values[i])
+
+
+def is_prime_many(values):
+    """
+    Test lots of integers for primality at once, returning an `array('B')`
+    with a 1 for each prime and a 0 for everything else.
+
+    `values` may be any buffer of 64-bit integers (e.g. an `array('q')`,
+    `array('Q')` or a numpy `int64`/`uint64` array), which is read in
+    place, or any iterable of integers below `2**64`.
+
+    Each value is trial divided by the primes below 256 and anything left
+    over is checked with a Miller-Rabin test using bases which are known to
+    make it deterministic for 64-bit numbers, so there are no false
+    positives. The whole loop runs without the GIL.
+    """
+    try:
+        view = memoryview(values)
+    except TypeError:
+        view = None
+
+    if view is None or view.ndim != 1 or view.itemsize != 8 or \
+            view.format not in ('q', 'l', 'Q', 'L'):
+        values = list(values)
+        if not all(isinstance(value, int) for value in values):
+            raise TypeError('values must be integers')
+        try:
+            view = memoryview(array('q', values))
+        except OverflowError:
+            try:
+                view = memoryview(array('Q', [max(value, 0)
+                                              for value in values]))
+            except OverflowError:
+                raise ValueError('values must be less than 2**64')
+
+    result = array('B', bytes(len(view)))
+    if view.format in ('q', 'l'):
+        _check_signed(view, result)
+    else:
+        _check_unsigned(view, result)
+    return result
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef long long _prime_count(long long n, long long v, int[::1] smalls,
+                            int[::1] roughs, long long[::1] larges,
+                            unsigned char[::1] composite) noexcept nogil:
+    """
+    Lucy_Hedgehog's prime counting method, working only with odd numbers.
+
+    For each odd `k` up to `sqrt(n)`, `smalls[k // 2]` and (while `k` is
+    still "rough", i.e. has no prime factors found so far) `larges` hold
+    how many odd numbers up to `k` and `n // k` respectively are left
+    after crossing off the multiples of every prime up to the current one.
+    Crossing off the multiples of each odd prime `p` up to `n**(1/4)`
+    updates both tables in place, and the primes between `n**(1/4)` and
+    `sqrt(n)` are counted from what's left at the end.
+    """
+    cdef:
+        Py_ssize_t s = (v + 1) // 2, ns, i, j, k, l, e
+        long long p, q, d, m, c, t, found = 0
+
+    for i in range(s):
+        smalls[i] = i
+        roughs[i] = 2 * i + 1
+        larges[i] = (n // (2 * i + 1) - 1) // 2
+
+    for p in range(3, v + 1, 2):
+        if composite[p // 2]:
+            continue
+        q = p * p
+        if q * q > n:
+            break
+
+        composite[p // 2] = 1
+        i = q // 2
+        while i < (v + 1) // 2:
+            composite[i] = 1
+            i += p
+
+        # Cross the multiples of p off the counts for each n // k
+        ns = 0
+        for k in range(s):
+            i = roughs[k]
+            if composite[i // 2]:
+                continue
+            d = i * p
+            if d <= v:
+                larges[ns] = larges[k] - larges[smalls[d // 2] - found] + found
+            else:
+                larges[ns] = larges[k] - smalls[(n // d - 1) // 2] + found
+            roughs[ns] = i
+            ns += 1
+        s = ns
+
+        # ... and for each k up to sqrt(n)
+        i = (v - 1) // 2
+        j = ((v // p) - 1) | 1
+        while j >= p:
+            c = smalls[j // 2] - found
+            e = (j * p) // 2
+            while i >= e:
+                smalls[i] -= c
+                i -= 1
+            j -= 2
+        found += 1
+
+    # Take away the numbers with exactly two prime factors above n**(1/4),
+    # which are all that is left besides the primes
+    larges[0] += (s + 2 * (found - 1)) * (s - 1) // 2
+    for k in range(1, s):
+        larges[0] -= larges[k]
+
+    for l in range(1, s):
+        q = roughs[l]
+        m = n // q
+        e = smalls[(m // q - 1) // 2] - found
+        if e < l + 1:
+            break
+        t = 0
+        for k in range(l + 1, e + 1):
+            t += smalls[(m // roughs[k] - 1) // 2]
+        larges[0] += t - (e - l) * (found + l - 1)
+
+    # The count so far is of the odd primes (and 1)
+    return larges[0] + 1
+
+
+def prime_count(n):
+    """
+    Count the primes less than or equal to `n`, without finding them.
+
+    This uses Lucy_Hedgehog's method, which takes O(n**(3/4) / log n)
+    time and O(sqrt(n)) memory, so counting the primes up to 10**12 needs
+    around 8 MB instead of the gigabytes that sieving would. Up to the
+    maximum of 2**62 is allowed, although that takes a while.
+    """
+    cdef:
+        long long limit, v, s, count
+        int[::1] smalls, roughs
+        long long[::1] larges
+        unsigned char[::1] composite
+
+    if not isinstance(n, int):
+        raise TypeError('n must be an integer')
+    if n < 0:
+        raise ValueError('n must not be negative')
+    if n > _MAX_LIMIT:
+        raise ValueError('n must be at most 2**62')
+
+    if n < 3:
+        return 0 if n < 2 else 1
+
+    limit = n
+    v = isqrt(n)
+    s = (v + 1) // 2
+    smalls = array('i', [0]) * s
+    roughs = array('i', [0]) * s
+    larges = array('q', [0]) * s
+    composite = bytearray(s)
+
+    with nogil:
+        count = _prime_count(limit, v, smalls, roughs, larges, composite)
+    return count
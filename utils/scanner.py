@@ -1,46 +1,601 @@
+import os
 import re
+import asyncio
+import bisect
+import mmap
+import functools
+from array import array
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from collections import namedtuple
 
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
 
-class StringScanner:
+
+_pattern_type = type(re.compile(''))
+
+
+class PatternCache:
     """
-    A scanner very similar to Ruby's StringScanner. 
-    
-    It is mainly designed to make lexing easy, but I'm sure there are loads 
-    of other useful applications too.  
+    A size-bounded cache of compiled regular expressions with
+    least-recently-used eviction.
+
+    The `re` module's internal cache is fairly small, so a lexer which uses
+    hundreds of distinct patterns will keep evicting its own patterns and
+    recompiling them. One `PatternCache` is shared by every scanner in the
+    process (see `pattern_cache`), but a scanner class can be given its own
+    by overriding its `pattern_cache` attribute.
+
+    Already compiled pattern objects are passed straight through without
+    being cached.
+
+    Parameters
+    ----------
+    maxsize: int or None
+        The maximum number of patterns to keep. None means unbounded and 0
+        disables caching. (default: 1024)
     """
-    def __init__(self, text=None, position=0):
-        self.text = text
-        self.pos = position
-        self.match = None
-        
-    def search(self, pattern, advance_pointer=True, 
-                return_string=True, from_pointer=True):
+    def __init__(self, maxsize=1024):
+        self.resize(maxsize)
+
+    def resize(self, maxsize):
         """
-        The function that does most of the heavy lifting. The 
+        Change the maximum number of cached patterns.
+
+        This empties the cache and resets the hit/miss counters.
         """
-        search_func = re.match if from_pointer else re.search
-        pattern = re.compile(pattern)
-        
-        match = search_func(pattern, self.text[self.pos:])
-        
-        # Set the match register using whatever we found
+        if maxsize is not None and (not isinstance(maxsize, int) or maxsize < 0):
+            raise ValueError('maxsize must be None or a non-negative integer')
+        self._compile = functools.lru_cache(maxsize)(re.compile)
+
+    def compile(self, pattern, flags=0):
+        """
+        Get the compiled version of `pattern`, compiling and caching it if
+        this is the first time it has been seen.
+        """
+        if isinstance(pattern, _pattern_type):
+            return pattern
+        return self._compile(pattern, flags)
+
+    def clear(self):
+        """
+        Empty the cache and reset the hit/miss counters.
+        """
+        self._compile.cache_clear()
+
+    def info(self):
+        """
+        Get a `(hits, misses, maxsize, currsize)` named tuple of cache
+        statistics.
+        """
+        return self._compile.cache_info()
+
+    @property
+    def maxsize(self):
+        return self.info().maxsize
+
+    @property
+    def hits(self):
+        return self.info().hits
+
+    @property
+    def misses(self):
+        return self.info().misses
+
+    def __len__(self):
+        return self.info().currsize
+
+    def __repr__(self):
+        info = self.info()
+        return '<{}: size={}/{} hits={} misses={}>'.format(
+                self.__class__.__name__,
+                info.currsize, info.maxsize, info.hits, info.misses)
+
+
+pattern_cache = PatternCache()
+"""
+The process-wide pattern cache used by `StringScanner` and its subclasses.
+"""
+
+
+# The anchors which depend on what comes after (or before) them
+_FORWARD_AT_CODES = (sre_parse.AT_BOUNDARY, sre_parse.AT_NON_BOUNDARY,
+                     sre_parse.AT_END, sre_parse.AT_END_LINE,
+                     sre_parse.AT_END_STRING)
+_BACKWARD_AT_CODES = (sre_parse.AT_BOUNDARY, sre_parse.AT_NON_BOUNDARY,
+                      sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_LINE,
+                      sre_parse.AT_BEGINNING_STRING)
+
+
+def _has_assertion(item, forward):
+    """
+    Check whether part of a parsed pattern contains a lookaround or anchor
+    which looks forwards (or backwards) from where it is.
+    """
+    if isinstance(item, sre_parse.SubPattern):
+        return any(_has_assertion(entry, forward) for entry in item)
+    if isinstance(item, (list, tuple)):
+        if len(item) == 2 and item[0] in (sre_parse.ASSERT,
+                                          sre_parse.ASSERT_NOT):
+            direction, subpattern = item[1]
+            return ((direction > 0) == forward or
+                    _has_assertion(subpattern, forward))
+        if len(item) == 2 and item[0] is sre_parse.AT:
+            codes = _FORWARD_AT_CODES if forward else _BACKWARD_AT_CODES
+            return item[1] in codes
+        return any(_has_assertion(entry, forward) for entry in item)
+    return False
+
+
+@functools.lru_cache(maxsize=None)
+def _looks_behind(regex):
+    r"""
+    Check whether a compiled pattern can see the text before where it
+    starts matching (with `^`, `\A`, `\b`, `\B` or a lookbehind).
+    """
+    return _has_assertion(sre_parse.parse(regex.pattern, regex.flags),
+                          forward=False)
+
+
+class _ShiftedMatch:
+    """
+    A match found in `string[offset:]`, which reports its positions as
+    indices into `string` like a match made in place would.
+    """
+    __slots__ = ('_match', '_offset', 'string')
+
+    def __init__(self, match, offset, string):
+        self._match = match
+        self._offset = offset
+        self.string = string
+
+    def start(self, group=0):
+        start = self._match.start(group)
+        return start + self._offset if start >= 0 else start
+
+    def end(self, group=0):
+        end = self._match.end(group)
+        return end + self._offset if end >= 0 else end
+
+    def span(self, group=0):
+        return self.start(group), self.end(group)
+
+    def group(self, *groups):
+        return self._match.group(*groups)
+
+    @property
+    def lastindex(self):
+        return self._match.lastindex
+
+
+class _Sentinel:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+    def __reduce__(self):
+        # Unpickle as the module-level constant so identity checks still work
+        return self.name
+
+
+class _LineIndex:
+    """
+    The positions of newlines in a scanner's input, built up incrementally
+    so lines and columns can be found with a binary search.
+
+    Only newlines at or after `start` are remembered individually. For
+    anything before that (i.e. text which has been discarded) we just keep
+    count of how many there were and where the last one was.
+    """
+    _newline = {str: re.compile('\n'), bytes: re.compile(b'\n')}
+
+    def __init__(self, start=0):
+        self.offsets = []
+        self.start = start
+        self.end = start
+        self.count = 0
+        self.last = -1
+
+    def extend(self, text, base, upto):
+        """
+        Index the newlines in `text` (which starts at position `base`) up
+        to position `upto`.
+        """
+        upto = min(upto, base + len(text))
+        if upto <= self.end:
+            return
+
+        newline = self._newline[str if isinstance(text, str) else bytes]
+        self.offsets.extend(base + match.start() for match in
+                            newline.finditer(text, self.end - base, upto - base))
+        self.end = upto
+
+    def forget(self, text, base, keep):
+        """
+        Stop remembering newlines before position `keep`, because that part
+        of `text` is about to be thrown away.
+        """
+        if keep <= self.end:
+            i = bisect.bisect_left(self.offsets, keep)
+            if i:
+                self.count += i
+                self.last = self.offsets[i - 1]
+                del self.offsets[:i]
+        else:
+            # Nobody has asked about this bit yet, so just count it
+            newline = '\n' if isinstance(text, str) else b'\n'
+            start, stop = self.end - base, keep - base
+            skipped = text.count(newline, start, stop)
+            if skipped:
+                self.last = base + text.rindex(newline, start, stop)
+            elif self.offsets:
+                self.last = self.offsets[-1]
+            self.count += len(self.offsets) + skipped
+            self.offsets = []
+            self.end = keep
+        self.start = keep
+
+    def line_col(self, pos):
+        if pos <= self.last:
+            raise IndexError('Position {} has already been discarded'.format(
+                pos))
+
+        i = bisect.bisect_left(self.offsets, pos)
+        last_newline = self.offsets[i - 1] if i else self.last
+        return self.count + i + 1, pos - last_newline
+
+
+class _ScannerCore:
+    """
+    The handful of `StringScanner` methods which get called for every token
+    (or character) scanned.
+
+    These are replaced by the compiled versions in `utils._scanner` when
+    that extension has been built, unless the `UTILS_PURE_PYTHON`
+    environment variable is set.
+    """
+    # The position of text[0] in the overall input. This is only non-zero
+    # for scanners which throw away text that has already been consumed.
+    _base = 0
+
+    def search(self, pattern, advance_pointer=True,
+                return_string=True, from_pointer=True):
+        r"""
+        The function that does most of the heavy lifting.
+
+        The pattern is matched in place, starting at the scan pointer (using
+        the `pos` argument of a compiled pattern), so no copies of the
+        remaining text are made and each call only costs as much as the
+        match itself.
+
+        Note
+        ----
+        Patterns which can look behind where they start (`^`, `\A`, `\b`,
+        `\B` and lookbehind assertions) are matched against a copy of the
+        rest of the text instead, so that, as with any other pattern, the
+        scan pointer behaves like the start of the string. Those patterns
+        cost O(remaining text) per call.
+        """
+        regex = self.pattern_cache.compile(pattern)
+        match = self._find(regex, from_pointer)
+        start = self.pos
+
+        # Set the match register using whatever we found. When searching,
+        # the register also holds everything skipped over on the way. It's
+        # only sliced out of the text if somebody actually wants it.
         if match:
-            index = match.span()[0] + len(match.group())
-            self.match = self.text[self.pos:self.pos + index]
+            base = self._base
+            end = base + match.end()
+            self._span = (start, base + match.start(), end)
+            if return_string:
+                self._match = match.string[start - base:match.end()]
+            else:
+                self._match = None
         else:
+            end = start
             self.match = None
-            
+
         # Advance the pointer if necessary
         if advance_pointer:
-            self.pos += len(self.match) if self.match else 0
-            
+            self.pos = end
+
         # And finally return something. Either the match itself
         # or the number of characters found
         if return_string:
-            return self.match
+            return self._match
         else:
-            return len(self.match) if self.match else 0
-        
+            return end - start
+
+    def getch(self):
+        """
+        Get the next character from the string.
+        """
+        character = self.current_char
+        self.pos += 1
+        self.match = character
+        return character
+
+    def peek(self, n=1):
+        """
+        Get the next n characters.
+        """
+        # Reading the text may compact it and move _base
+        text = self.text
+        start = self.pos - self._base + 1
+        return text[start:start + n]
+
+    @property
+    def current_char(self):
+        """
+        Get the current string. If we are at the end of the text, then return 
+        None.  
+        """
+        text = self.text
+        index = self.pos - self._base
+        if index == len(text):
+            return None
+        else:
+            return text[index]
+      
+    @property
+    def end_of_string(self):
+        """
+        Check whether the scanner is at the end of the string.
+        """
+        text = self.text
+        return self.pos - self._base == len(text)
+
+
+if not os.environ.get('UTILS_PURE_PYTHON'):
+    try:
+        from . import _scanner
+    except ImportError:
+        pass
+    else:
+        # Scanners stay plain Python objects, they just get compiled methods
+        class _ScannerCore(_ScannerCore):
+            search = _scanner.search
+            getch = _scanner.getch
+            peek = _scanner.peek
+            current_char = property(_scanner.current_char)
+            end_of_string = property(_scanner.end_of_string)
+
+
+class StringScanner(_ScannerCore):
+    """
+    A scanner very similar to Ruby's StringScanner. 
+    
+    It is mainly designed to make lexing easy, but I'm sure there are loads 
+    of other useful applications too.  
+
+    Patterns may be strings or pre-compiled pattern objects. Strings are
+    compiled through `pattern_cache`.
+
+    Parameters
+    ----------
+    text: str
+        The text to scan.
+    position: int
+        Where to start scanning from. (default: 0)
+    compact: bool
+        Whether text which has already been consumed may be thrown away when
+        more text is `append()`-ed. Positions are unaffected, but `text` will
+        then only hold the unconsumed part of the input. (default: False)
+    """
+    pattern_cache = pattern_cache
+
+    def __init__(self, text=None, position=0, compact=False):
+        self.text = text
+        self.pos = position
+        self.match = None
+        self.compact = compact
+        self._marks = []
+
+    @property
+    def match(self):
+        """
+        The match register, holding the text matched by the last operation
+        (or None if it failed).
+
+        After a search the register is only sliced out of the text when
+        somebody asks for it, so skipping over large blocks is cheap.
+        """
+        if self._match is None and self._span is not None:
+            start, _, end = self._span
+            self._match = self.text[start - self._base:end - self._base]
+        return self._match
+
+    @match.setter
+    def match(self, value):
+        self._match = value
+        self._span = None
+
+    @property
+    def pre_match(self):
+        """
+        The text skipped over by the last successful search before the
+        pattern itself matched (e.g. by `scan_until()`), or None if the
+        last operation wasn't a successful search.
+
+        Like the match register, this is only sliced out when asked for.
+        """
+        if self._span is None:
+            return None
+        start, match_start, _ = self._span
+        return self.text[start - self._base:match_start - self._base]
+
+    def _match_length(self):
+        if self._span is not None:
+            return self._span[2] - self._span[0]
+        return len(self._match) if self._match else 0
+
+    @property
+    def text(self):
+        """
+        The text being scanned.
+        """
+        if self._pending:
+            self._flush()
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self._text = value
+        self._pending = []
+        self._lines = _LineIndex(self._base)
+
+    def _find(self, regex, from_pointer=True):
+        """
+        Run a compiled regex against the text at the scan pointer without
+        touching the scanner's state.
+
+        Positions in the returned match object are indices into `self.text`.
+        """
+        text = self.text
+        offset = self.pos - self._base
+
+        if offset and _looks_behind(regex):
+            # Anchors and lookbehinds mustn't see text that has already been
+            # scanned, so match these against a copy of the rest of the text
+            rest = text[offset:]
+            if from_pointer:
+                match = regex.match(rest)
+            else:
+                match = regex.search(rest)
+            return match and _ShiftedMatch(match, offset, text)
+
+        if from_pointer:
+            return regex.match(text, offset)
+        else:
+            return regex.search(text, offset)
+
+    def _horizon(self):
+        """
+        Get the index into `self.text` which a match must end before for it
+        to be unaffected by input that hasn't been seen yet.
+        """
+        return len(self.text) + 1
+
+    def _read_more(self):
+        """
+        Read more input into the buffer, returning False if there isn't any.
+        """
+        return False
+
+    def scan_until(self, pattern):
+        """
+        Scan forward to the next occurrence of a pattern, returning
+        everything up to and including it (or None if there isn't one). The
+        text before the occurrence is available from `pre_match`.
+
+        The search starts at the scan pointer without copying anything.
+        """
+        return self.search(pattern, from_pointer=False)
+
+    def skip_until(self, pattern):
+        """
+        Like `scan_until()`, but returns the number of characters skipped.
+        Nothing is copied, so this is a cheap way of skipping large blocks.
+        """
+        return self.search(pattern, return_string=False, from_pointer=False)
+
+    def check_until(self, pattern):
+        """
+        Like `scan_until()`, but without advancing the scan pointer.
+        """
+        return self.search(pattern, advance_pointer=False, from_pointer=False)
+
+    def exist(self, pattern):
+        """
+        Look ahead for a pattern without advancing the scan pointer,
+        returning the number of characters up to the end of its next
+        occurrence, or None if there isn't one.
+        """
+        length = self.search(pattern, advance_pointer=False,
+                             return_string=False, from_pointer=False)
+        return None if self._span is None else length
+
+    def iter_matches(self, pattern, advance=True, limit=None):
+        r"""
+        Generate every (non-overlapping) occurrence of a pattern in the rest
+        of the text, up to `limit` of them.
+
+        This is driven by the regex engine's `finditer()` from the scan
+        pointer, so pulling out lots of matches is much faster than calling
+        `scan_until()` in a loop.
+
+        Once the generator finishes (or is closed) the match register holds
+        the last occurrence and, if `advance` is set, the scan pointer sits
+        just past it. Don't use the scanner for anything else while the
+        generator is running.
+
+        Example
+        -------
+        ::
+
+            >>> scanner = StringScanner('1 + 22 * 333')
+            >>> list(scanner.iter_matches(r'\d+', limit=2))
+            ['1', '22']
+            >>> scanner.pos
+            6
+        """
+        regex = self.pattern_cache.compile(pattern)
+        if not advance:
+            mark = self.mark()
+
+        pos = self.pos
+        last = None
+        count = 0
+
+        try:
+            while limit is None or count < limit:
+                base = self._base
+                horizon = self._horizon()
+
+                for found in regex.finditer(self.text, pos - base):
+                    start, end = found.span()
+                    if end >= horizon:
+                        # This match may be able to grow with more input
+                        break
+
+                    # An empty match can't directly follow another empty
+                    # match (finditer() only enforces that within one call)
+                    if (start == end and last is not None and
+                            last[0] == last[1] == base + start):
+                        continue
+
+                    last = (base + start, base + end)
+                    pos = base + end
+                    count += 1
+                    yield found.string[start:end]
+                    if count == limit:
+                        return
+
+                if horizon > len(self.text):
+                    return
+
+                # Let the buffer drop anything we've finished with before
+                # reading more
+                self.pos = pos
+                self._read_more()
+        finally:
+            if advance:
+                self.pos = pos
+            else:
+                self.reset(mark)
+
+            if last is None:
+                self.match = None
+            else:
+                self._match = None
+                self._span = (last[0], last[0], last[1])
+
     def check(self, pattern):
         """
         This will check the string for a pattern, returning the matched 
@@ -77,53 +632,160 @@ class StringScanner:
         ----
         You can only go back one step.
         """
-        self.pos -= len(self.match) if self.match else 0
+        self.pos -= self._match_length()
         self.match = None
         
-    def getch(self):
+    def mark(self):
         """
-        Get the next character from the string.
+        Save a checkpoint of the scanner's position and match register on
+        the rewind stack, returning a handle which can be given to
+        `reset()` or `commit()`.
+
+        Checkpoints are cheap (no text is copied), so they're handy for
+        speculative parsing. They can be nested as deeply as you like.
         """
-        character = self.current_char
-        self.pos += 1
-        self.match = character
-        return character
-        
+        self._marks.append((self.pos, self._match, self._span))
+        return len(self._marks) - 1
+
+    def reset(self, mark=None):
+        """
+        Rewind to a checkpoint (by default the most recent one), discarding
+        it and any checkpoints made after it.
+        """
+        if mark is None:
+            mark = len(self._marks) - 1
+        if not 0 <= mark < len(self._marks):
+            raise IndexError('No such checkpoint: {}'.format(mark))
+        self.pos, self._match, self._span = self._marks[mark]
+        del self._marks[mark:]
+
+    def commit(self, mark=None):
+        """
+        Discard a checkpoint (by default the most recent one) and any
+        checkpoints made after it without rewinding.
+        """
+        if mark is None:
+            mark = len(self._marks) - 1
+        if not 0 <= mark < len(self._marks):
+            raise IndexError('No such checkpoint: {}'.format(mark))
+        del self._marks[mark:]
+
+    @contextmanager
+    def attempt(self):
+        r"""
+        A context manager which saves a checkpoint on entry, committing it if
+        the block succeeds and rewinding to it if an exception is raised.
+
+        Example
+        -------
+        ::
+
+            try:
+                with scanner.attempt():
+                    name = scanner.scan(r'\w+')
+                    if not scanner.scan(r'\('):
+                        raise SyntaxError('Not a function call')
+                    ...
+            except SyntaxError:
+                # The scanner is back where it started
+                ...
+        """
+        mark = self.mark()
+        try:
+            yield self
+        except BaseException:
+            self.reset(mark)
+            raise
+        else:
+            self.commit(mark)
+
     def append(self, value):
         """
         Append the string to the scanner's text.
+
+        Appended chunks are only joined onto the text the next time it is
+        needed, so appending is O(1). If the scanner was created with
+        `compact=True`, consumed text is dropped at the same time and a
+        scanner which is continually fed (e.g. from a socket) never has to
+        copy more than the unconsumed text.
         """
-        self.text += value
-        
-    def peek(self, n=1):
+        self._pending.append(value)
+
+    def _flush(self):
         """
-        Get the next n characters.
+        Join any pending chunks onto the end of the text.
         """
-        return self.text[self.pos+1: self.pos+1+n]
-    
-    def __getitem__(self, value):
+        if self.compact:
+            self._discard()
+
+        pending = self._pending
+        self._pending = []
+        self._text = self._text[:0].join([self._text] + pending)
+
+    def _discard(self):
         """
-        Get a particular character or substring from the underlying text.
+        Drop consumed text from the front of the buffer, keeping the match
+        register (and anything a checkpoint may rewind to) around so
+        `unscan()` and `reset()` still work.
+
+        To keep this amortised O(1), text is only dropped once it makes up
+        at least half of the buffer.
         """
-        return self.text[value]
-    
-    @property
-    def current_char(self):
+        keep = self.pos - self._match_length()
+        for pos, match, span in self._marks:
+            if span is not None:
+                keep = min(keep, span[0])
+            else:
+                keep = min(keep, pos - (len(match) if match else 0))
+        dead = keep - self._base
+
+        if dead > 0 and 2 * dead >= len(self._text):
+            self._lines.forget(self._text, self._base, keep)
+            self._text = self._text[dead:]
+            self._base = keep
+
+    def line_col(self, pos=None):
         """
-        Get the current string. If we are at the end of the text, then return 
-        None.  
+        Get the line and column (both starting from 1) of a position in the
+        input, by default the scan pointer.
+
+        The positions of newlines are indexed lazily and the index is
+        extended as more text is scanned or appended, so each lookup is
+        O(log n) instead of re-counting newlines from the start.
         """
-        if self.end_of_string:
-            return None
-        else:
-            return self.text[self.pos]
-      
-    @property
-    def end_of_string(self):
+        if pos is None:
+            pos = self.pos
+        self._lines.extend(self.text, self._base, pos)
+        return self._lines.line_col(pos)
+
+    def _local(self, index):
         """
-        Check whether the scanner is at the end of the string.
+        Convert a position in the overall input to an index into `text`.
         """
-        return self.pos == len(self.text)
+        if index is None or index < 0:
+            return index
+        if index < self._base:
+            raise IndexError('Position {} has already been discarded'.format(
+                index))
+        return index - self._base
+
+    def __getitem__(self, value):
+        """
+        Get a particular character or substring from the underlying text.
+
+        Indices are positions in the overall input, so they stay valid after
+        consumed text has been discarded (asking for discarded text raises
+        an IndexError). Negative indices count back from the end.
+        """
+        text = self.text
+        if self._base:
+            if isinstance(value, slice):
+                value = slice(self._local(value.start),
+                              self._local(value.stop),
+                              value.step)
+            else:
+                value = self._local(value)
+        return text[value]
     
     @property
     def rest(self):
@@ -131,7 +793,7 @@ class StringScanner:
         Returns the "rest" of the string. (i.e. everything between the 
         scanner pointer and the end of the string) 
         """
-        return self.text[self.pos:]
+        return self.text[self.pos - self._base:]
     
     def __repr__(self):
         max_chars = 30
@@ -139,3 +801,1199 @@ class StringScanner:
                 self.__class__.__name__,
                 self.pos,
                 self.text[:max_chars] + '...' if len(self.text) > max_chars else self.text)
+
+
+class BytesScanner(StringScanner):
+    """
+    A `StringScanner` which works directly on binary data using bytes
+    patterns.
+
+    The data can be anything supporting the buffer protocol (`bytes`,
+    `bytearray`, `memoryview`, `mmap.mmap`, ...) and is never copied or
+    decoded. `text` is a `memoryview` of the data, so the match register,
+    `rest`, `peek()`, `getch()` and slices of the scanner are all zero-copy
+    views as well. Call `bytes()` on a view if you need to keep it around.
+
+    Use `BytesScanner.from_file()` to memory-map a file from disk, or use
+    the scanner as a context manager to release the view when you're done
+    (an `mmap` can't be closed while views of it are alive).
+
+    Note
+    ----
+    Like `bytes`, indexing with an integer returns an int.
+    """
+    def __init__(self, data=b'', position=0):
+        super().__init__(memoryview(data).cast('B'), position)
+        self._file = None
+        self._mmap = None
+
+    @classmethod
+    def from_file(cls, filename):
+        """
+        Create a scanner over the contents of a file without reading it into
+        memory.
+        """
+        f = open(filename, 'rb')
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            f.close()
+            return cls(b'')
+
+        scanner = cls(data)
+        scanner._file = f
+        scanner._mmap = data
+        return scanner
+
+    def close(self):
+        """
+        Release the underlying buffer (and close the file if the scanner was
+        created using `from_file()`).
+
+        Any views previously handed out by the scanner must be released
+        before a memory-mapped file can be closed.
+        """
+        self.match = None
+        self.text.release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, value):
+        """
+        Append some bytes to the scanner's data.
+
+        Note
+        ----
+        This has to copy everything into a new buffer.
+        """
+        self.text = memoryview(self.text.tobytes() + bytes(value))
+
+    @property
+    def current_char(self):
+        """
+        Get the current byte (as a view of length 1). If we are at the end of
+        the data, then return None.
+        """
+        if self.end_of_string:
+            return None
+        else:
+            index = self.pos - self._base
+            return self.text[index:index + 1]
+
+    def __repr__(self):
+        max_chars = 30
+        return '<{}: position={} text={}>'.format(
+                self.__class__.__name__,
+                self.pos,
+                repr(self.text[:max_chars].tobytes()) +
+                ('...' if len(self.text) > max_chars else ''))
+
+
+def _read_chunks(stream, size):
+    while True:
+        chunk = stream.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+class StreamScanner(StringScanner):
+    """
+    A `StringScanner` which reads its input from a file-like object or an
+    iterable of string chunks instead of needing it all up front.
+
+    Text is read into a buffer on demand and the part of the buffer which
+    has already been consumed is periodically thrown away, so scanning (or
+    lexing, see `Lexer.tokenize()`) a huge file only needs a bounded amount
+    of memory.
+
+    Positions (`pos`, indices passed to `scanner[...]`, token offsets) are
+    always relative to the start of the stream, while `text` only holds the
+    current buffer.
+
+    Matches are allowed to span chunk boundaries. A pattern is only matched
+    once at least `lookahead` characters are buffered past the scan
+    pointer, and any match which runs up to the end of the buffer is
+    retried with more text before being accepted.
+
+    Note
+    ----
+    A failed match (or a lookahead assertion) can only see `lookahead`
+    characters past the scan pointer. `search(..., from_pointer=False)`
+    keeps reading until it finds a match, while `rest` and negative indices
+    read the rest of the stream into memory.
+
+    Parameters
+    ----------
+    source: file-like object or iterable of str
+        Where to read text from.
+    chunk_size: int
+        How many characters to read from a file-like object at a time.
+        (default: 65536)
+    lookahead: int
+        The minimum number of characters to buffer past the scan pointer
+        before matching. This should be at least as long as the longest
+        token. (default: 4096)
+    """
+    def __init__(self, source, chunk_size=65536, lookahead=4096):
+        super().__init__('')
+        if hasattr(source, 'read'):
+            self._chunks = _read_chunks(source, chunk_size)
+        else:
+            self._chunks = iter(source)
+        self.chunk_size = chunk_size
+        self.lookahead = lookahead
+        self.eof = False
+
+    def _read_more(self):
+        """
+        Read the next chunk into the buffer, returning False if the stream
+        is exhausted.
+        """
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self.eof = True
+            return False
+
+        self._discard()
+        self._text += chunk
+        return True
+
+    def _ensure(self, n):
+        """
+        Try to make sure there are at least `n` characters buffered past the
+        scan pointer.
+        """
+        while (not self.eof and
+               len(self.text) - (self.pos - self._base) < n):
+            self._read_more()
+
+    def _find(self, regex, from_pointer=True):
+        while True:
+            self._ensure(self.lookahead)
+            match = super()._find(regex, from_pointer)
+
+            if self.eof:
+                return match
+
+            if match is None:
+                if from_pointer:
+                    return None
+            elif match.end() < len(self.text):
+                return match
+
+            # The match ran into the end of the buffer (so it may be able to
+            # grow), or we're searching and haven't found anything yet
+            self._read_more()
+
+    def _horizon(self):
+        if self.eof:
+            return len(self.text) + 1
+        return len(self.text) - self.lookahead
+
+    def __getitem__(self, value):
+        """
+        Get a particular character or substring using positions in the
+        overall stream.
+
+        Asking for text which has already been discarded raises an
+        IndexError, and negative indices count back from the end of the
+        text which has been read so far.
+        """
+        if isinstance(value, slice):
+            start, stop = value.start, value.stop
+            if stop is None or stop < 0 or (start is not None and start < 0):
+                self._read_all()
+            else:
+                self._ensure(stop - self.pos)
+        elif value < 0:
+            self._read_all()
+        else:
+            self._ensure(value + 1 - self.pos)
+
+        return super().__getitem__(value)
+
+    def _read_all(self):
+        while self._read_more():
+            pass
+
+    def peek(self, n=1):
+        self._ensure(n + 1)
+        return super().peek(n)
+
+    @property
+    def current_char(self):
+        self._ensure(1)
+        return super().current_char
+
+    @property
+    def end_of_string(self):
+        self._ensure(1)
+        return super().end_of_string
+
+    @property
+    def rest(self):
+        """
+        Returns the "rest" of the stream, reading all of it into memory.
+        """
+        self._read_all()
+        return super().rest
+
+
+@functools.lru_cache(maxsize=None)
+def _max_width(regex):
+    """
+    The length of the longest string a compiled pattern can match (which
+    is huge if it contains an unbounded repeat).
+    """
+    return sre_parse.parse(regex.pattern, regex.flags).getwidth()[1]
+
+
+@functools.lru_cache(maxsize=None)
+def _looks_ahead(regex):
+    r"""
+    Check whether a compiled pattern contains an assertion which looks past
+    the end of what it matches (a lookahead, `\b`, `\B`, `$` or `\Z`).
+    Those count as zero width, so whether they succeed can change when more
+    data arrives even if the match itself doesn't.
+    """
+    return _has_assertion(sre_parse.parse(regex.pattern, regex.flags),
+                          forward=True)
+
+
+class AsyncScanner(StringScanner):
+    r"""
+    A scanner for lexing network protocols straight off an
+    `asyncio.StreamReader`.
+
+    `search()` (and so `scan()`, `skip()`, `check()`, `scan_until()`,
+    `skip_until()`, `check_until()` and `exist()`) are coroutines which only
+    wait for more data when the answer could still change once it arrives:
+
+    - A match which ends before the end of the buffer is accepted straight
+      away.
+    - A match which runs up to the end of the buffer is accepted if it is
+      as long as the pattern allows (e.g. a fixed delimiter like
+      `rb'\r\n'`), otherwise we wait for more data or EOF.
+    - A failed match is only final once `lookahead` bytes (or as many as
+      the pattern could possibly match, if that's fewer) are buffered past
+      the scan pointer.
+    - A failed search keeps reading until the pattern turns up.
+    - Patterns with assertions that look past the end of the match (a
+      lookahead, `\b`, `\B`, `$` or `\Z`) are only answered once
+      `lookahead` bytes are buffered past the end of the match (or past
+      the scan pointer, if it fails), or at EOF.
+
+    Data is only read from the reader when a pattern needs it, so a slow
+    consumer leaves data sitting in the reader (which in turn pauses the
+    transport). If more than `max_buffer` unconsumed bytes would be needed
+    to answer a question, `asyncio.LimitOverrunError` is raised instead of
+    buffering a whole message.
+
+    Everything else (`getch()`, `peek()`, `rest`, `iter_matches()`, ...)
+    only looks at what has already been buffered.
+
+    Note
+    ----
+    Text is kept as bytes, so patterns must be bytes patterns. In
+    request/response protocols a variable-length token sitting at the end
+    of a message will wait for the peer to say something else, so end
+    messages with a fixed delimiter and use something like
+    `await scanner.scan_until(rb'\r\n')`.
+
+    Parameters
+    ----------
+    reader: asyncio.StreamReader
+        Where to read data from.
+    chunk_size: int
+        The most bytes to ask the reader for at a time. (default: 65536)
+    lookahead: int
+        How many bytes past the scan pointer a failed match may need to
+        see. This should be at least as long as the longest token.
+        (default: 4096)
+    max_buffer: int
+        The maximum number of unconsumed bytes to buffer. (default: 1 MB)
+    """
+    def __init__(self, reader, chunk_size=65536, lookahead=4096,
+                 max_buffer=1024 * 1024):
+        super().__init__(b'')
+        self.reader = reader
+        self.chunk_size = chunk_size
+        self.lookahead = lookahead
+        self.max_buffer = max_buffer
+        self.eof = False
+
+    async def _receive(self):
+        """
+        Read some more data into the buffer, returning False if the reader
+        is exhausted.
+        """
+        buffered = len(self.text) - (self.pos - self._base)
+        if buffered >= self.max_buffer:
+            raise asyncio.LimitOverrunError(
+                'More than {} bytes buffered past position {}'.format(
+                    self.max_buffer, self.pos), buffered)
+
+        data = await self.reader.read(
+            min(self.chunk_size, self.max_buffer - buffered))
+        if not data:
+            self.eof = True
+            return False
+
+        self._discard()
+        self._text += data
+        return True
+
+    def _is_final(self, regex, from_pointer):
+        """
+        Check whether matching a pattern against the buffer gives the same
+        answer it would with more data.
+        """
+        match = self._find(regex, from_pointer)
+        looks_ahead = _looks_ahead(regex)
+        if match is None:
+            if not from_pointer:
+                return False
+            buffered = len(self.text) - (self.pos - self._base)
+            if looks_ahead:
+                return buffered >= self.lookahead
+            return buffered >= min(self.lookahead, _max_width(regex))
+
+        # Assertions past the end of the match need to see what follows it
+        if looks_ahead:
+            return len(self.text) - match.end() >= self.lookahead
+        return (match.end() < len(self.text) or
+                match.end() - match.start() >= _max_width(regex))
+
+    async def search(self, pattern, advance_pointer=True,
+                     return_string=True, from_pointer=True):
+        """
+        Wait until there's enough data to match a pattern, then do exactly
+        what `StringScanner.search()` does.
+        """
+        regex = self.pattern_cache.compile(pattern)
+        while not self.eof and not self._is_final(regex, from_pointer):
+            await self._receive()
+        return super().search(regex, advance_pointer, return_string,
+                              from_pointer)
+
+    async def exist(self, pattern):
+        """
+        The awaitable version of `StringScanner.exist()`.
+        """
+        length = await self.search(pattern, advance_pointer=False,
+                                   return_string=False, from_pointer=False)
+        return None if self._span is None else length
+
+    async def at_eof(self):
+        """
+        Wait until there's either more data past the scan pointer (False)
+        or the reader is exhausted and everything has been scanned (True).
+        """
+        while self.pos - self._base == len(self.text):
+            if self.eof or not await self._receive():
+                return True
+        return False
+
+    def __repr__(self):
+        max_chars = 30
+        return '<{}: position={} text={}>'.format(
+                self.__class__.__name__,
+                self.pos,
+                repr(self.text[:max_chars]) +
+                ('...' if len(self.text) > max_chars else ''))
+
+
+# Flags which can be switched on or off for part of a regex with (?imsx:...)
+_SCOPED_FLAGS = [(re.IGNORECASE, 'i'), (re.MULTILINE, 'm'), (re.DOTALL, 's'),
+                 (re.VERBOSE, 'x')]
+
+
+def _scoped(pattern, flags):
+    """
+    Get the source of a compiled pattern, wrapped in an inline group which
+    gives it back its own flags when it's embedded in a regex compiled with
+    `flags`.
+    """
+    on = ''.join(letter for flag, letter in _SCOPED_FLAGS
+                 if pattern.flags & flag and not flags & flag)
+    off = ''.join(letter for flag, letter in _SCOPED_FLAGS
+                  if flags & flag and not pattern.flags & flag)
+
+    # re.UNICODE is implied for str patterns, so only compare the rest
+    scoped = re.IGNORECASE | re.MULTILINE | re.DOTALL | re.VERBOSE
+    if (pattern.flags ^ flags) & ~scoped & ~re.UNICODE:
+        raise ValueError('The flags of {!r} can not be combined with the '
+                         'lexer\'s flags'.format(pattern))
+
+    if not on and not off:
+        return pattern.pattern
+    return '(?{}{}:{})'.format(on, '-' + off if off else '', pattern.pattern)
+
+
+SKIP = _Sentinel('SKIP')
+"""
+The action for `Lexer` rules whose matches should be dropped.
+"""
+
+
+Token = namedtuple('Token', 'type value start end line column')
+Token.__new__.__defaults__ = (None, None)
+Token.__doc__ = """
+A single token produced by a `Lexer`, along with the `[start, end)` span of
+text it was created from and (if the lexer tracks lines) the line and column
+it starts at.
+"""
+
+
+class LexError(ValueError):
+    """
+    Raised when a `Lexer` finds text that none of its rules match.
+    """
+    def __init__(self, message, pos):
+        super().__init__(message)
+        self.pos = pos
+
+    def __reduce__(self):
+        return self.__class__, (self.args[0], self.pos)
+
+
+class Lexer:
+    r"""
+    A table-driven lexer which compiles an ordered list of token rules into
+    one master regex.
+
+    Instead of trying every rule in turn with `StringScanner.scan()`, each
+    token costs a single match against an alternation of all the rules. As
+    with the hand-written loop, earlier rules win when more than one of them
+    matches.
+
+    Each rule is a `(name, pattern, action)` tuple, where the action is
+    optional and may be
+
+    - None, in which case the token's value is the matched text,
+    - `Lexer.SKIP`, meaning the matched text is dropped (e.g. whitespace or
+      comments), or
+    - a callable taking `(scanner, text)` which returns the token's value.
+      The action may move the scanner's pointer (e.g. to consume a
+      heredoc) and lexing will carry on from wherever it is left.
+
+    Example
+    -------
+    ::
+
+        lexer = Lexer([
+            ('NUMBER', r'\d+', lambda scanner, text: int(text)),
+            ('NAME', r'\w+'),
+            ('OP', r'[-+*/=]'),
+            ('WHITESPACE', r'\s+', Lexer.SKIP),
+        ])
+
+        for token in lexer.tokenize('x = 42'):
+            print(token)
+
+    Note
+    ----
+    Every rule is wrapped in its own group, so rules which refer back to
+    their own groups should use named groups (`(?P=name)`) rather than
+    numbered ones. Rules must not match the empty string.
+
+    Parameters
+    ----------
+    rules: list
+        The ordered token table. Patterns may be strings or compiled
+        patterns, which keep their own `re.IGNORECASE`, `re.MULTILINE`,
+        `re.DOTALL` and `re.VERBOSE` flags.
+    flags: int
+        Regex flags used when compiling the master regex. (default: 0)
+    errors: str
+        What to do with text that no rule matches. "strict" raises a
+        `LexError`, "ignore" drops it, and "token" yields it as an `ERROR`
+        token. In the last two cases lexing resumes at the next position
+        where some rule matches. (default: "strict")
+    track_lines: bool
+        Whether to record the line and column each token starts at (see
+        `StringScanner.line_col()`). (default: False)
+    """
+    SKIP = SKIP
+    ERROR = 'ERROR'
+
+    def __init__(self, rules, flags=0, errors='strict', track_lines=False):
+        if errors not in ('strict', 'ignore', 'token'):
+            raise ValueError('errors must be one of "strict", "ignore" or '
+                             '"token", not {!r}'.format(errors))
+
+        self.rules = []
+        parts = []
+        for i, entry in enumerate(rules):
+            name, pattern, action = (tuple(entry) + (None,))[:3]
+            if isinstance(pattern, _pattern_type):
+                pattern = _scoped(pattern, flags)
+            parts.append('(?P<_rule{}>{})'.format(i, pattern))
+            self.rules.append((name, pattern, action))
+
+        self.flags = flags
+        self.errors = errors
+        self.track_lines = track_lines
+        self.regex = re.compile('|'.join(parts), flags)
+
+        # Map the group number of each rule straight to the rule itself
+        self._groups = {}
+        for i, entry in enumerate(self.rules):
+            self._groups[self.regex.groupindex['_rule{}'.format(i)]] = entry
+
+        # Number each token type for tokenize_compact()
+        self.token_types = []
+        for name, pattern, action in self.rules:
+            if action is not SKIP and name not in self.token_types:
+                self.token_types.append(name)
+        if self.ERROR not in self.token_types:
+            self.token_types.append(self.ERROR)
+
+    def tokenize(self, text):
+        """
+        Lazily turn some text into a stream of `Token`s.
+
+        `text` may be a string or a `StringScanner` (including a
+        `StreamScanner`). When given a scanner, lexing starts at its current
+        position and its pointer and match register are kept up to date as
+        tokens are generated.
+        """
+        if isinstance(text, StringScanner):
+            scanner = text
+        else:
+            scanner = StringScanner(text)
+
+        match = self.regex.match
+        groups = self._groups
+        skip = self.SKIP
+        track_lines = self.track_lines
+
+        while not scanner.end_of_string:
+            text = scanner.text
+            base = scanner._base
+            horizon = scanner._horizon()
+            pos = scanner.pos - base
+
+            if track_lines:
+                # Look the line up once, then keep track of it ourselves
+                newline = '\n' if isinstance(text, str) else b'\n'
+                line, column = scanner.line_col()
+                line_start = pos - column + 1
+
+            # The fast path: keep matching inside the current buffer for as
+            # long as the results can't be changed by unread input.
+            while True:
+                found = match(text, pos)
+                if found is None:
+                    break
+                end = found.end()
+                if end >= horizon or end == pos:
+                    break
+
+                name, pattern, action = groups[found.lastindex]
+
+                if track_lines:
+                    token_line, column = line, pos - line_start + 1
+                    newlines = found.group().count(newline)
+                    if newlines:
+                        line += newlines
+                        line_start = pos + found.group().rindex(newline) + 1
+
+                if action is skip:
+                    pos = end
+                    continue
+
+                value = found.group()
+                scanner.pos = base + end
+                scanner.match = value
+                if action is not None:
+                    value = action(scanner, value)
+                if track_lines:
+                    yield Token(name, value, base + pos, scanner.pos,
+                                token_line, column)
+                else:
+                    yield Token(name, value, base + pos, scanner.pos)
+
+                # Someone may have moved the scanner while we were away
+                if (scanner.text is not text or action is not None or
+                        scanner.pos != base + end):
+                    pos = None
+                    break
+                pos = end
+
+            if pos is None:
+                continue
+            scanner.pos = base + pos
+            if not scanner.end_of_string:
+                token = self._step(scanner)
+                if token is not None:
+                    yield token
+
+    def tokenize_compact(self, text):
+        """
+        Tokenize a whole string into a `TokenArray`, which stores each token
+        as a type id and start/end offsets in flat arrays instead of as a
+        `Token`.
+
+        This takes around a dozen bytes per token instead of a few hundred,
+        which matters when there are tens of millions of them. The tokens'
+        text is only sliced out when asked for, so rule actions (other than
+        `SKIP`) are not run.
+        """
+        tokens = TokenArray(text, self.token_types,
+                            track_lines=self.track_lines)
+        add_type = tokens.types.append
+        add_start = tokens.starts.append
+        add_end = tokens.ends.append
+        match = self.regex.match
+        ids = {}
+        for group, (name, pattern, action) in self._groups.items():
+            ids[group] = None if action is SKIP else self.token_types.index(name)
+        error_id = self.token_types.index(self.ERROR)
+        scanner = tokens.scanner
+        pos = 0
+        length = len(text)
+
+        while pos < length:
+            found = match(text, pos)
+            if found is None or found.end() == pos:
+                scanner.pos = pos
+                if self._recover(scanner) is not None:
+                    tokens._add(error_id, pos, scanner.pos)
+                pos = scanner.pos
+                continue
+
+            type_id = ids[found.lastindex]
+            end = found.end()
+            if type_id is not None:
+                add_type(type_id)
+                add_start(pos)
+                add_end(end)
+            pos = end
+
+        scanner.pos = pos
+        scanner.match = None
+        return tokens
+
+    def tokenize_parallel(self, text, boundary=r'\n', chunk_size=1 << 22,
+                          workers=None):
+        """
+        Tokenize a large string by splitting it into chunks and lexing them
+        in a pool of worker processes.
+
+        Chunks are roughly `chunk_size` characters long and always end just
+        after a match of the `boundary` pattern (by default a newline). The
+        tokens are yielded in order with the same offsets (and lines and
+        columns) as `tokenize()` would give, so the output is identical as
+        long as no token, skipped match or error spans a boundary.
+
+        The lexer (including the rules' actions) has to be picklable, so
+        actions should be module-level functions, and actions only see the
+        chunk they're in.
+
+        Note
+        ----
+        Every token still has to be sent back to (and rebuilt in) this
+        process, which costs around a microsecond per token. This pays off
+        best when the rules or actions are expensive compared to that.
+
+        Parameters
+        ----------
+        text: str
+            The text to tokenize.
+        boundary: str or compiled pattern
+            Where it's safe to split the text. (default: newlines)
+        chunk_size: int
+            The approximate number of characters sent to each worker at a
+            time. (default: 4 MiB)
+        workers: int or None
+            The number of worker processes. None means one per CPU.
+        """
+        workers = workers or os.cpu_count() or 1
+        chunks = self._chunks(text, boundary, chunk_size)
+        make_token = tuple.__new__
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # Only keep a couple of chunks per worker in flight so we don't
+            # end up with a copy of the entire input in the queue
+            in_flight = deque()
+            limit = 2 * workers
+
+            for start, end, lines_before, last_newline in chunks:
+                in_flight.append(pool.submit(
+                    _tokenize_chunk, self, text[start:end], start,
+                    lines_before, last_newline))
+                if len(in_flight) >= limit:
+                    for token in in_flight.popleft().result():
+                        yield make_token(Token, token)
+
+            while in_flight:
+                for token in in_flight.popleft().result():
+                    yield make_token(Token, token)
+
+    def _chunks(self, text, boundary, chunk_size):
+        """
+        Split the text into `(start, end, lines_before, last_newline)`
+        chunks, where the last two say how many newlines come before `start`
+        and where the last of them is.
+        """
+        boundary = pattern_cache.compile(boundary)
+        newline = '\n' if isinstance(text, str) else b'\n'
+        start = 0
+        lines_before = 0
+        last_newline = -1
+
+        while start < len(text):
+            found = boundary.search(text, start + chunk_size)
+            end = found.end() if found else len(text)
+
+            yield start, end, lines_before, last_newline
+
+            if self.track_lines:
+                lines_before += text.count(newline, start, end)
+                last_newline = max(last_newline, text.rfind(newline, start, end))
+            start = end
+
+    def _step(self, scanner):
+        """
+        Lex a single token the slow way, reading more input or recovering
+        from errors as necessary.
+        """
+        found = scanner._find(self.regex)
+        if found is None or found.end() == found.start():
+            return self._recover(scanner)
+
+        name, pattern, action = self._groups[found.lastindex]
+        start = scanner._base + found.start()
+        value = found.group()
+        scanner.pos = scanner._base + found.end()
+        scanner.match = value
+
+        if action is self.SKIP:
+            return None
+        if action is not None:
+            value = action(scanner, value)
+        return self._token(scanner, name, value, start)
+
+    def _token(self, scanner, name, value, start):
+        if self.track_lines:
+            line, column = scanner.line_col(start)
+            return Token(name, value, start, scanner.pos, line, column)
+        return Token(name, value, start, scanner.pos)
+
+    def _recover(self, scanner):
+        """
+        Deal with unmatched text at the scan pointer according to the error
+        policy, moving the scanner to where lexing should resume and
+        returning an error token if one should be emitted.
+        """
+        start = scanner.pos
+        if self.errors == 'strict':
+            raise LexError('No rule matches {!r} at position {}'.format(
+                scanner[start:start + 20], start), start)
+
+        # Resume at the next place a (non-empty) rule matches
+        bad = []
+        while True:
+            bad.append(scanner.getch())
+            if scanner.end_of_string:
+                break
+            found = scanner._find(self.regex)
+            if found is not None and found.end() > found.start():
+                break
+
+        bad = ''.join(bad)
+        scanner.match = bad
+
+        if self.errors == 'token':
+            return self._token(scanner, self.ERROR, bad, start)
+        return None
+
+
+class TokenArray:
+    """
+    A compact list of tokens, stored as parallel arrays of token type ids
+    and start/end offsets into the original text (see
+    `Lexer.tokenize_compact()`).
+
+    It can be indexed, sliced and iterated over like a list of `Token`s,
+    which are created on the fly. Use `types`, `starts` and `ends` directly
+    to avoid creating any objects at all.
+
+    Parameters
+    ----------
+    text: str
+        The text the tokens came from.
+    names: list
+        The token type names, indexed by type id.
+    track_lines: bool
+        Whether the `Token`s should have their line and column filled in.
+        (default: False)
+    """
+    def __init__(self, text, names, track_lines=False):
+        self.text = text
+        self.names = names
+        self.track_lines = track_lines
+        self.scanner = StringScanner(text)
+
+        offset_type = 'I' if len(text) < 2 ** 32 else 'Q'
+        self.types = array('H' if len(names) < 2 ** 16 else 'I')
+        self.starts = array(offset_type)
+        self.ends = array(offset_type)
+
+    def _add(self, type_id, start, end):
+        self.types.append(type_id)
+        self.starts.append(start)
+        self.ends.append(end)
+
+    def type(self, index):
+        """
+        Get the name of a token's type.
+        """
+        return self.names[self.types[index]]
+
+    def value(self, index):
+        """
+        Get a token's text.
+        """
+        return self.text[self.starts[index]:self.ends[index]]
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        start = self.starts[index]
+        end = self.ends[index]
+        name = self.names[self.types[index]]
+        if self.track_lines:
+            line, column = self.scanner.line_col(start)
+            return Token(name, self.text[start:end], start, end, line, column)
+        return Token(name, self.text[start:end], start, end)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return '<{}: {} tokens>'.format(self.__class__.__name__, len(self))
+
+
+def _tokenize_chunk(lexer, text, start, lines_before, last_newline):
+    """
+    Lex one chunk of a larger piece of text for `Lexer.tokenize_parallel()`.
+    """
+    scanner = StringScanner(text)
+    # Pretend the chunk is part of the whole text so offsets, lines and
+    # columns all come out right
+    scanner._base = scanner.pos = start
+    scanner._lines = _LineIndex(start)
+    scanner._lines.count = lines_before
+    scanner._lines.last = last_newline
+
+    # Plain tuples are much cheaper to send back than named tuples
+    return [tuple(token) for token in lexer.tokenize(scanner)]
+
+
+class ParseError(ValueError):
+    """
+    Raised by a `Parser` when a rule fails to match.
+    """
+    def __init__(self, message, pos):
+        super().__init__(message)
+        self.pos = pos
+
+    def __reduce__(self):
+        return self.__class__, (self.args[0], self.pos)
+
+
+class MemoTable:
+    """
+    The packrat table used by a `Parser` to remember the outcome of each
+    `(rule, position)` it has tried, so no rule is ever parsed twice at the
+    same place.
+
+    This table never forgets anything. See `LRUMemoTable` and
+    `WindowMemoTable` for ones which keep memory bounded on long inputs.
+    """
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, key, pos):
+        """
+        Look up the outcome of a rule at a position, returning None if it
+        hasn't been tried yet.
+        """
+        return self._entries.get((key, pos))
+
+    def put(self, key, pos, outcome):
+        self._entries[(key, pos)] = outcome
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class LRUMemoTable(MemoTable):
+    """
+    A `MemoTable` which holds at most `maxsize` entries, evicting the least
+    recently used ones first.
+    """
+    def __init__(self, maxsize=100000):
+        super().__init__()
+        self._entries = OrderedDict()
+        self.maxsize = maxsize
+
+    def get(self, key, pos):
+        outcome = self._entries.get((key, pos))
+        if outcome is not None:
+            self._entries.move_to_end((key, pos))
+        return outcome
+
+    def put(self, key, pos, outcome):
+        if self.maxsize <= 0:
+            return
+        self._entries[(key, pos)] = outcome
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+class WindowMemoTable(MemoTable):
+    """
+    A `MemoTable` which forgets everything more than `window` characters
+    behind the furthest position it has seen.
+
+    This suits grammars which never backtrack very far, and keeps memory
+    proportional to the window instead of to the input.
+    """
+    def __init__(self, window=4096):
+        super().__init__()
+        self.window = window
+        self._furthest = 0
+        self._oldest = 0
+
+    def get(self, key, pos):
+        return self._entries.get((key, pos))
+
+    def put(self, key, pos, outcome):
+        self._entries[(key, pos)] = outcome
+        self._furthest = max(self._furthest, pos)
+
+        # Prune in batches to keep it amortised O(1)
+        cutoff = self._furthest - self.window
+        if cutoff - self._oldest > self.window:
+            self._entries = {k: v for k, v in self._entries.items()
+                             if k[1] >= cutoff}
+            self._oldest = cutoff
+
+    def clear(self):
+        super().clear()
+        self._furthest = self._oldest = 0
+
+
+def rule(method):
+    """
+    Turn a method of a `Parser` subclass into a memoized grammar rule.
+
+    A rule either returns a value or raises a `ParseError`, in which case
+    the scanner is rewound to wherever the rule started. Whatever happens is
+    recorded in the parser's packrat table, so trying the same rule at the
+    same position again just replays the outcome. Any arguments the rule
+    takes become part of the key and must be hashable.
+
+    Note
+    ----
+    Left-recursive rules aren't supported.
+    """
+    @functools.wraps(method)
+    def memoized(self, *args):
+        scanner = self.scanner
+        start = scanner.pos
+        key = (method, args) if args else method
+
+        outcome = self.memo.get(key, start)
+        if outcome is not None:
+            result, end = outcome
+            if end is None:
+                raise result
+            scanner.pos = end
+            return result
+
+        mark = scanner.mark()
+        try:
+            result = method(self, *args)
+        except ParseError as e:
+            scanner.reset(mark)
+            self.memo.put(key, start, (e.with_traceback(None), None))
+            raise
+
+        scanner.commit(mark)
+        self.memo.put(key, start, (result, scanner.pos))
+        return result
+
+    return memoized
+
+
+class Parser:
+    r"""
+    A base class for packrat (memoizing recursive-descent) parsers built on
+    top of a `StringScanner`.
+
+    Grammar rules are methods decorated with `rule`, and are written with
+    the small set of combinators below. Because every `(rule, position)` is
+    only ever parsed once, grammars which retry alternatives run in linear
+    time instead of (potentially) exponential time.
+
+    Example
+    -------
+    ::
+
+        class Calculator(Parser):
+            @rule
+            def expr(self):
+                return self.choice(self.sum, self.term)
+
+            @rule
+            def sum(self):
+                left = self.term()
+                self.expect(r'\+')
+                return left + self.expr()
+
+            @rule
+            def term(self):
+                return self.choice(self.number, self.parens)
+
+            @rule
+            def number(self):
+                return int(self.expect(r'\d+'))
+
+            @rule
+            def parens(self):
+                self.expect(r'\(')
+                value = self.expr()
+                self.expect(r'\)')
+                return value
+
+        Calculator('1+(2+3)').parse('expr')  # 6
+
+    Parameters
+    ----------
+    text: str or StringScanner
+        The text to parse.
+    memo: MemoTable
+        The packrat table to use, which decides how (or whether) old
+        entries are evicted. (default: an unbounded `MemoTable`)
+    """
+    def __init__(self, text, memo=None):
+        if isinstance(text, StringScanner):
+            self.scanner = text
+        else:
+            self.scanner = StringScanner(text)
+        self.memo = MemoTable() if memo is None else memo
+        self._furthest = None
+
+    def parse(self, start, complete=True):
+        """
+        Run a rule (given by name) from the current position. If `complete`
+        is true, the rule must consume the rest of the input.
+
+        On failure, the error which got furthest into the input is raised
+        since that's usually the most helpful one.
+        """
+        try:
+            result = getattr(self, start)()
+            if complete and not self.scanner.end_of_string:
+                self.fail('Expected the end of the input')
+        except ParseError as e:
+            furthest = self._furthest
+            if furthest is None or furthest.pos < e.pos:
+                raise
+            raise furthest from None
+        return result
+
+    def fail(self, message):
+        """
+        Fail at the current position.
+        """
+        pos = self.scanner.pos
+        error = ParseError('{} at position {}'.format(message, pos), pos)
+        if self._furthest is None or pos >= self._furthest.pos:
+            self._furthest = error
+        raise error
+
+    def expect(self, pattern):
+        """
+        Scan a pattern, failing if it doesn't match.
+        """
+        text = self.scanner.scan(pattern)
+        if text is None:
+            if isinstance(pattern, _pattern_type):
+                pattern = pattern.pattern
+            self.fail('Expected {!r}'.format(pattern))
+        return text
+
+    def choice(self, *alternatives):
+        """
+        Try each alternative (a callable, usually a rule) in turn, returning
+        the result of the first one to succeed. If they all fail, the error
+        which got furthest is re-raised.
+        """
+        error = None
+        for alternative in alternatives:
+            mark = self.scanner.mark()
+            try:
+                result = alternative()
+            except ParseError as e:
+                self.scanner.reset(mark)
+                if error is None or e.pos >= error.pos:
+                    error = e
+            else:
+                self.scanner.commit(mark)
+                return result
+
+        if error is None:
+            self.fail('No alternatives')
+        raise error
+
+    def optional(self, parser, default=None):
+        """
+        Try a callable, returning `default` if it fails.
+        """
+        return self.choice(parser, lambda: default)
+
+    def many(self, parser, minimum=0):
+        """
+        Call a parser until it fails, returning a list of the results. At
+        least `minimum` results are required.
+        """
+        results = []
+        while True:
+            mark = self.scanner.mark()
+            start = self.scanner.pos
+            try:
+                results.append(parser())
+            except ParseError:
+                self.scanner.reset(mark)
+                if len(results) < minimum:
+                    raise
+                return results
+            self.scanner.commit(mark)
+
+            # Don't loop forever on something which matches nothing
+            if self.scanner.pos == start:
+                return results